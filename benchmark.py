@@ -0,0 +1,965 @@
+#!/usr/bin/env python
+"""Benchmark pyformat."""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import pyformat
+
+
+PYFORMAT_BIN = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                            'pyformat.py')
+
+
+SMALL_SOURCE = '''\
+import os
+
+
+def foo(x):
+    """Return x."""
+    return "abc" + x
+'''
+
+
+def per_file_overhead(args):
+    """Compare per-file cost of rebuilding the pipeline against reusing it."""
+    def rebuilt():
+        pyformat._pipelines.clear()
+        pyformat.format_code(SMALL_SOURCE, aggressive=args.aggressive)
+
+    def reused():
+        pyformat.format_code(SMALL_SOURCE, aggressive=args.aggressive)
+
+    reused()
+
+    for name, function in [('rebuilt', rebuilt), ('reused', reused)]:
+        seconds = min(timeit.repeat(function,
+                                    number=args.number,
+                                    repeat=args.repeat)) / args.number
+        print('{:>10}: {:8.3f} ms per file'.format(name, 1000 * seconds))
+
+
+def daemon_latency(args):
+    """Compare a cold command-line run against a daemon round trip."""
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'socket')
+    filename = os.path.join(directory, 'example.py')
+    with open(filename, 'w') as output_file:
+        output_file.write(SMALL_SOURCE)
+
+    def cold():
+        subprocess.call([sys.executable, PYFORMAT_BIN, '--no-cache',
+                         filename],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+
+    def client():
+        subprocess.call([sys.executable, PYFORMAT_BIN, '--no-cache',
+                         '--use-daemon', '--socket', socket_path, filename],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+
+    def round_trip():
+        assert pyformat.format_code_with_daemon(SMALL_SOURCE,
+                                                socket_path) is not None
+
+    daemon = subprocess.Popen([sys.executable, PYFORMAT_BIN, '--daemon',
+                               '--socket', socket_path],
+                              stderr=subprocess.DEVNULL)
+    try:
+        while pyformat.format_code_with_daemon('', socket_path) is None:
+            time.sleep(0.05)
+
+        for name, function in [('cold', cold),
+                               ('client', client),
+                               ('round trip', round_trip)]:
+            seconds = min(timeit.repeat(function,
+                                        number=args.number,
+                                        repeat=args.repeat)) / args.number
+            print('{:>10}: {:8.3f} ms per file'.format(name, 1000 * seconds))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        os.remove(filename)
+        os.rmdir(directory)
+
+
+def scheduler_throughput(args):
+    """Compare pool.map scheduling against the streaming scheduler."""
+    import io
+    import multiprocessing
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    source = pyformat.format_code(SMALL_SOURCE)
+    filenames = []
+    for index in range(args.files):
+        filename = os.path.join(directory, 'file{}.py'.format(index))
+        with open(filename, 'w') as output_file:
+            output_file.write(source)
+        filenames.append(filename)
+
+    options = pyformat.parse_args(['benchmark', '--no-cache',
+                                   '--jobs', str(args.jobs)] + filenames)
+
+    def legacy():
+        pool = multiprocessing.Pool(args.jobs)
+        pool.map(pyformat._format_file,
+                 [(name, options, None, None, None)
+                  for name in filenames])
+        pool.close()
+        pool.join()
+
+    def streaming():
+        pyformat.format_multiple_files(filenames, options,
+                                       standard_out=io.StringIO(),
+                                       standard_error=io.StringIO())
+
+    try:
+        for name, function in [('pool.map', legacy),
+                               ('streaming', streaming)]:
+            seconds = min(timeit.repeat(function, number=1,
+                                        repeat=args.repeat))
+            print('{:>10}: {:8.1f} files per second'.format(
+                name, args.files / seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+def standard_library_files():
+    """Yield Python files of the standard library."""
+    directory = os.path.dirname(os.__file__)
+    for root, directories, children in os.walk(directory):
+        directories[:] = sorted(d for d in directories
+                                if d not in ('site-packages', 'test', 'tests'))
+        for name in sorted(children):
+            if name.endswith('.py'):
+                yield os.path.join(root, name)
+
+
+def read_sources(filenames, limit):
+    """Return up to limit (filename, source) pairs of decodable files."""
+    sources = []
+    for filename in filenames:
+        if len(sources) >= limit:
+            break
+        try:
+            sources.append((filename, pyformat.read_file(filename)[0]))
+        except (OSError, UnicodeDecodeError):
+            continue
+    return sources
+
+
+def prune_speedup(args):
+    """Compare the full pipeline against the pruned one on the stdlib."""
+    pipeline = pyformat.get_pipeline(aggressive=args.aggressive,
+                                     sort_imports=True,
+                                     add_trailing_comma=bool(args.aggressive))
+    sources = read_sources(standard_library_files(), args.files)
+
+    times = {True: 0.0, False: 0.0}
+    mismatches = 0
+    for (filename, source) in sources:
+        outputs = {}
+        for prune in (False, True):
+            start_time = time.perf_counter()
+            outputs[prune] = pipeline(source, prune=prune)
+            times[prune] += time.perf_counter() - start_time
+        if outputs[True] != outputs[False]:
+            mismatches += 1
+            print('mismatch: {}'.format(filename), file=sys.stderr)
+
+    print('{:>10}: {:8.3f} s'.format('full', times[False]))
+    print('{:>10}: {:8.3f} s'.format('pruned', times[True]))
+    print('{} files, {} mismatches'.format(len(sources), mismatches))
+    return 1 if mismatches else 0
+
+
+def line_range_cost(args):
+    """Compare formatting whole files against formatting a few lines."""
+    pipeline = pyformat.get_pipeline(aggressive=args.aggressive)
+    sources = read_sources(standard_library_files(), args.files)
+
+    times = {'whole': 0.0, 'ranged': 0.0}
+    for (_, source) in sources:
+        middle = max(source.count('\n') // 2, 1)
+        for (name, line_ranges) in [
+            ('whole', None),
+            ('ranged', [(middle, middle + args.lines - 1)]),
+        ]:
+            start_time = time.perf_counter()
+            pipeline(source, line_ranges=line_ranges)
+            times[name] += time.perf_counter() - start_time
+
+    for name in ('whole', 'ranged'):
+        print('{:>10}: {:8.3f} s'.format(name, times[name]))
+    print('{} files, {} lines per range'.format(len(sources), args.lines))
+
+
+def synthetic_module(lines):
+    """Return generated source of about the given number of lines."""
+    template = '''\
+class Generated{0}(object):
+
+    """Generated class {0}."""
+
+    def method(self, x):
+        """  Return x.  """
+        if x == None:
+            return {{"key": "value", "index": {0}}}
+        return [x,x,x]
+
+
+'''
+    count = max(lines // template.count('\n'), 1)
+    return 'import os\n\n\n' + ''.join(template.format(index)
+                                       for index in range(count))
+
+
+def split_speedup(args):
+    """Compare formatting a large module whole against in parallel parts."""
+    source = synthetic_module(args.lines)
+
+    start_time = time.perf_counter()
+    whole = pyformat.format_code(source, aggressive=args.aggressive)
+    whole_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    split = pyformat.format_code_in_parallel(source, args.jobs,
+                                             aggressive=args.aggressive)
+    split_time = time.perf_counter() - start_time
+
+    print('{:>10}: {:8.3f} s'.format('whole', whole_time))
+    print('{:>10}: {:8.3f} s'.format('split', split_time))
+    print('{} lines, {} jobs, identical: {}'.format(
+        source.count('\n'), args.jobs, whole == split))
+    return 0 if whole == split else 1
+
+
+def encoded_variants(data):
+    """Return data as it would be saved in a few encodings."""
+    body = data.decode('utf-8') + '# caf\u00e9\n'
+    return [
+        data,
+        body.encode('utf-8'),
+        codecs.BOM_UTF8 + data,
+        ('# -*- coding: latin-1 -*-\n' + body).encode('latin-1'),
+        # No cookie, so this falls back to latin-1.
+        body.encode('latin-1'),
+    ]
+
+
+def legacy_decode_source(data):
+    """Return decoded source and encoding as lib2to3 detection gave them."""
+    import io
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from lib2to3.pgen2 import tokenize
+
+    input_file = io.BytesIO(data)
+    try:
+        encoding = tokenize.detect_encoding(input_file.readline)[0]
+        input_file.read().decode(encoding)
+    except (LookupError, SyntaxError, UnicodeDecodeError):
+        encoding = 'latin-1'
+    return data.decode(encoding), encoding
+
+
+def encoding_detection(args):
+    """Compare encoding detection against lib2to3 on a mixed corpus."""
+    corpus = []
+    sources = 0
+    for filename in standard_library_files():
+        if sources >= args.files:
+            break
+        with open(filename, 'rb') as input_file:
+            data = input_file.read()
+        try:
+            corpus += encoded_variants(data)
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            continue
+        sources += 1
+
+    functions = [('current', pyformat.decode_source)]
+    try:
+        legacy_decode_source(b'')
+    except ImportError:
+        print('lib2to3 is not available', file=sys.stderr)
+    else:
+        functions.append(('lib2to3', legacy_decode_source))
+
+    results = {}
+    for (name, function) in functions:
+        seconds = min(timeit.repeat(
+            lambda: [function(data) for data in corpus],
+            number=1, repeat=args.repeat))
+        results[name] = [function(data) for data in corpus]
+        print('{:>10}: {:8.1f} files per second'.format(
+            name, len(corpus) / seconds))
+
+    mismatches = sum(current != legacy for (current, legacy) in
+                     zip(results['current'], results.get('lib2to3', [])))
+    print('{} files, {} mismatches'.format(len(corpus), mismatches))
+    return 1 if mismatches else 0
+
+
+def unchanged_files(args):
+    """Measure time and memory of a cached run over mostly formatted files."""
+    import io
+    import shutil
+    import tracemalloc
+
+    directory = tempfile.mkdtemp()
+    cache_directory = os.path.join(directory, 'cache')
+    formatted_source = pyformat.format_code(SMALL_SOURCE)
+    filenames = []
+    for index in range(args.files):
+        filename = os.path.join(directory, 'file{}.py'.format(index))
+        with open(filename, 'w') as output_file:
+            output_file.write(SMALL_SOURCE if index % args.changed_every == 0
+                              else formatted_source)
+        # Files modified just now are not recorded in the stat index.
+        os.utime(filename, (time.time() - 3600,) * 2)
+        filenames.append(filename)
+
+    def run(mode, jobs=1):
+        options = pyformat.parse_args(
+            ['benchmark', '--cache-dir', cache_directory,
+             '--jobs', str(jobs)] + (['--check'] if mode == 'check' else []) +
+            filenames)
+        return pyformat.format_multiple_files(filenames, options,
+                                              standard_out=io.StringIO(),
+                                              standard_error=io.StringIO())
+
+    try:
+        # Fill the result cache.
+        run('diff', jobs=args.jobs)
+
+        for mode in ('check', 'diff'):
+            seconds = min(timeit.repeat(lambda: run(mode), number=1,
+                                        repeat=args.repeat))
+            tracemalloc.start()
+            run(mode)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:>10}: {:8.1f} files per second, {:8.1f} KiB peak'.format(
+                mode, args.files / seconds, peak / 1024))
+    finally:
+        shutil.rmtree(directory)
+
+
+def synthetic_tree(directory, entries, excluded_share):
+    """Create about entries files below directory and return exclusions.
+
+    excluded_share of the files go to vendored and build directories,
+    which the returned patterns exclude. The rest are Python files spread
+    over nested packages.
+    """
+    excluded = int(entries * excluded_share)
+    groups = [('vendor', excluded // 2, '.js'),
+              ('build', excluded - excluded // 2, '.o'),
+              ('src', entries - excluded, '.py')]
+    for (top, count, extension) in groups:
+        for index in range(count):
+            subdirectory = os.path.join(directory, top,
+                                        'package{}'.format(index // 1000),
+                                        'module{}'.format(index // 50 % 20))
+            if index % 50 == 0:
+                os.makedirs(subdirectory, exist_ok=True)
+            with open(os.path.join(subdirectory,
+                                   'file{}{}'.format(index, extension)),
+                      'w') as output_file:
+                output_file.write('x = 1\n')
+    return ['vendor', 'build']
+
+
+def discovery_speed(args):
+    """Compare autopep8.find_files() against pyformat.find_files()."""
+    import autopep8
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    try:
+        exclude = synthetic_tree(directory, args.entries, args.excluded)
+
+        finders = [
+            ('autopep8', lambda: autopep8.find_files([directory], True,
+                                                     exclude)),
+            ('scandir', lambda: pyformat.find_files([directory], True,
+                                                    exclude)),
+            ('threads', lambda: pyformat.find_files([directory], True,
+                                                    exclude,
+                                                    jobs=args.jobs)),
+        ]
+        results = {}
+        for (name, finder) in finders:
+            first_times = []
+            total_times = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                files = finder()
+                found = [next(files)]
+                first_times.append(time.perf_counter() - start_time)
+                found.extend(files)
+                total_times.append(time.perf_counter() - start_time)
+            results[name] = sorted(found)
+            print('{:>10}: {:8.3f} s, first file after {:8.3f} s'.format(
+                name, min(total_times), min(first_times)))
+    finally:
+        shutil.rmtree(directory)
+
+    identical = all(found == results['autopep8']
+                    for found in results.values())
+    print('{} files found, identical: {}'.format(len(results['autopep8']),
+                                                 identical))
+    return 0 if identical else 1
+
+
+def gitignore_speed(args):
+    """Measure discovery with .gitignore rules on a mostly ignored tree."""
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    try:
+        entries = args.files + args.ignored
+        ignored = synthetic_tree(directory, entries, args.ignored / entries)
+        os.mkdir(os.path.join(directory, '.git'))
+        with open(os.path.join(directory, '.gitignore'), 'w') as output_file:
+            output_file.write(''.join(name + '/\n' for name in ignored))
+
+        finders = [
+            ('unpruned', lambda: pyformat.find_files([directory], True, [])),
+            ('exclude', lambda: pyformat.find_files([directory], True,
+                                                    ignored)),
+            ('gitignore', lambda: pyformat.find_files([directory], True, [],
+                                                      gitignore=True)),
+        ]
+        for (name, finder) in finders:
+            seconds = min(timeit.repeat(lambda: sum(1 for _ in finder()),
+                                        number=1, repeat=args.repeat))
+            print('{:>10}: {:8.3f} s, {} files'.format(
+                name, seconds, sum(1 for _ in finder())))
+    finally:
+        shutil.rmtree(directory)
+
+
+def git_index_check(args):
+    """Compare cached --check runs on a fresh clone with --git-index."""
+    import io
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    repository = os.path.join(directory, 'repository')
+    clone = os.path.join(directory, 'clone')
+    cache_directory = os.path.join(directory, 'cache')
+    source = pyformat.format_code(SMALL_SOURCE)
+
+    def git(*arguments):
+        subprocess.check_call(('git',) + arguments,
+                              stdout=subprocess.DEVNULL)
+
+    def run(path, options):
+        original_directory = os.getcwd()
+        os.chdir(path)
+        try:
+            pyformat._main(['pyformat', '--check', '--recursive',
+                            '--cache-dir', cache_directory,
+                            '--jobs', str(args.jobs), '.'] + options,
+                           io.StringIO(), io.StringIO())
+        finally:
+            os.chdir(original_directory)
+
+    try:
+        for index in range(args.files):
+            subdirectory = os.path.join(repository,
+                                        'package{}'.format(index // 100))
+            if index % 100 == 0:
+                os.makedirs(subdirectory)
+            with open(os.path.join(subdirectory, 'file{}.py'.format(index)),
+                      'w') as output_file:
+                output_file.write(source)
+        git('-C', repository, 'init', '-q')
+        git('-C', repository, 'add', '.')
+        git('-C', repository, '-c', 'user.name=benchmark',
+            '-c', 'user.email=benchmark@example.com', 'commit', '-q',
+            '-m', 'Add files')
+
+        for options in ([], ['--git-index']):
+            # Fill the result cache.
+            run(repository, options)
+
+        # Files of a fresh clone are unknown to the stat index.
+        for (name, options) in [('cached', []),
+                                ('git index', ['--git-index'])]:
+            times = []
+            for _ in range(args.repeat):
+                shutil.rmtree(clone, ignore_errors=True)
+                git('clone', '-q', repository, clone)
+                start_time = time.perf_counter()
+                run(clone, options)
+                times.append(time.perf_counter() - start_time)
+            print('{:>10}: {:8.3f} s'.format(name, min(times)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def clean_tree_check(args):
+    """Compare cached --check runs over a tree with one modified file."""
+    import contextlib
+    import io
+    import shutil
+    from unittest import mock
+
+    directory = tempfile.mkdtemp()
+    tree = os.path.join(directory, 'tree')
+    cache_directory = os.path.join(directory, 'cache')
+    source = pyformat.format_code(SMALL_SOURCE)
+    filenames = []
+
+    def run(options):
+        return pyformat._main(['pyformat', '--check',
+                               '--cache-dir', cache_directory] + options,
+                              io.StringIO(), io.StringIO())
+
+    try:
+        for index in range(args.files):
+            subdirectory = os.path.join(tree,
+                                        'package{}'.format(index // 1000),
+                                        'module{}'.format(index // 50 % 20))
+            if index % 50 == 0:
+                os.makedirs(subdirectory)
+            filename = os.path.join(subdirectory, 'file{}.py'.format(index))
+            with open(filename, 'w') as output_file:
+                output_file.write(source)
+            # Files modified just now are not recorded in the stat index.
+            os.utime(filename, (time.time() - 3600,) * 2)
+            filenames.append(filename)
+
+        # Fill the caches, then modify one file as an edit would.
+        run(['--recursive', tree])
+        with open(filenames[len(filenames) // 2], 'a') as output_file:
+            output_file.write('x = 1\n')
+
+        # Without summaries, each file is looked up in the stat index.
+        unsummarized = mock.patch.object(
+            pyformat.DirectorySummaries, 'select',
+            lambda self, directory, entries: entries)
+        for (name, patch) in [('stat index', unsummarized),
+                              ('summaries', contextlib.nullcontext())]:
+            with patch:
+                seconds = min(timeit.repeat(
+                    lambda: run(['--recursive', tree]), number=1,
+                    repeat=args.repeat))
+            print('{:>10}: {:8.3f} s'.format(name, seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+def corpus_files(count, max_size, seed):
+    """Return a fixed sample of files of the stdlib and site-packages.
+
+    The same environment, count, max_size and seed give the same files.
+    """
+    import random
+    import site
+
+    directories = [os.path.dirname(os.__file__)] + site.getsitepackages()
+    candidates = set()
+    for directory in directories:
+        for root, children, names in os.walk(directory):
+            children[:] = sorted(d for d in children
+                                 if d not in ('test', 'tests', '__pycache__'))
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith('.py') and os.path.getsize(path) <= max_size:
+                    candidates.add(path)
+
+    sample = random.Random(seed).sample(sorted(candidates),
+                                        min(count, len(candidates)))
+    return sorted(filename for (filename, _) in read_sources(sample, count))
+
+
+def option_matrix():
+    """Yield the format_code() options to benchmark."""
+    import itertools
+    for (aggressive, sort_imports, add_trailing_comma,
+         remove_unused_variables) in itertools.product(
+             (0, 1, 2), (False, True), (False, True), (False, True)):
+        if not aggressive and (add_trailing_comma or remove_unused_variables):
+            # These options require aggressive.
+            continue
+        yield {'aggressive': aggressive,
+               'sort_imports': sort_imports,
+               'add_trailing_comma': add_trailing_comma,
+               'remove_unused_variables': remove_unused_variables}
+
+
+def scenario_name(options):
+    """Return short name of benchmarked options."""
+    return 'a={aggressive}'.format(**options) + ''.join(
+        ' ' + label for (key, label) in [('sort_imports', 'sort'),
+                                         ('add_trailing_comma', 'comma'),
+                                         ('remove_unused_variables',
+                                          'unused')]
+        if options[key])
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of values."""
+    import math
+    ordered = sorted(values)
+    rank = max(int(math.ceil(percent / 100 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def measure_options(parameters):
+    """Return throughput, latency and memory of formatting with options.
+
+    The corpus is formatted repeat times. Latencies are the median of each
+    file over the repetitions. This runs in a fresh process, so that its
+    peak memory use is that of these options alone.
+    """
+    import resource
+    import statistics
+
+    (filenames, options, repeat) = parameters
+    sources = [pyformat.read_file(filename)[0] for filename in filenames]
+    # Import the formatters before timing.
+    pyformat.get_pipeline(**options)
+
+    repetitions = []
+    file_latencies = [[] for _ in sources]
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for (source, measured) in zip(sources, file_latencies):
+            file_start_time = time.perf_counter()
+            pyformat.format_code(source, **options)
+            measured.append(time.perf_counter() - file_start_time)
+        repetitions.append(time.perf_counter() - start_time)
+
+    seconds = statistics.median(repetitions)
+    latencies = [statistics.median(measured) for measured in file_latencies]
+
+    megabytes = sum(len(source.encode('utf-8')) for source in sources) / 1e6
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux reports kilobytes, macOS bytes.
+        peak_rss *= 1024
+
+    return {
+        'options': options,
+        'files': len(sources),
+        'seconds': seconds,
+        'repetitions': repetitions,
+        'files_per_second': len(sources) / seconds,
+        'megabytes_per_second': megabytes / seconds,
+        'latency': {'p50': percentile(latencies, 50),
+                    'p95': percentile(latencies, 95),
+                    'p99': percentile(latencies, 99)},
+        'latencies': latencies,
+        'peak_rss': peak_rss,
+    }
+
+
+def option_matrix_throughput(args):
+    """Measure format_code() on a fixed corpus across the option matrix."""
+    import hashlib
+    import json
+    import multiprocessing
+    import platform
+
+    filenames = corpus_files(args.files, args.max_size, args.seed)
+    corpus = []
+    for filename in filenames:
+        with open(filename, 'rb') as input_file:
+            data = input_file.read()
+        corpus.append({'path': filename, 'size': len(data),
+                       'sha256': hashlib.sha256(data).hexdigest()})
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(measure_options,
+                           [(filenames, options, args.repeat)
+                            for options in option_matrix()],
+                           chunksize=1)
+
+    print('{:<24} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'options', 'files/s', 'MB/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'RSS MB'))
+    for result in results:
+        print('{:<24} {:>8.1f} {:>8.3f} {:>8.1f} {:>8.1f} {:>8.1f} '
+              '{:>8.1f}'.format(
+                  scenario_name(result['options']),
+                  result['files_per_second'],
+                  result['megabytes_per_second'],
+                  1000 * result['latency']['p50'],
+                  1000 * result['latency']['p95'],
+                  1000 * result['latency']['p99'],
+                  result['peak_rss'] / 1e6))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'python': platform.python_version(),
+                       'pyformat': pyformat.__version__,
+                       'formatters': dict(pyformat.formatter_versions()),
+                       'seed': args.seed,
+                       'corpus': corpus,
+                       'results': results},
+                      output_file, indent=2)
+
+
+def bootstrap_ratio(baseline, current, confidence, resamples, seed=0):
+    """Return confidence interval of sum(current) / sum(baseline).
+
+    The values are paired per file and files are resampled with
+    replacement.
+    """
+    import random
+
+    generator = random.Random(seed)
+    count = len(baseline)
+    ratios = []
+    for _ in range(resamples):
+        indices = [generator.randrange(count) for _ in range(count)]
+        ratios.append(sum(current[index] for index in indices) /
+                      sum(baseline[index] for index in indices))
+    ratios.sort()
+
+    tail = (1 - confidence) / 2
+    return (ratios[int(tail * resamples)],
+            ratios[min(int((1 - tail) * resamples), resamples - 1)])
+
+
+def compare_results(args):
+    """Compare two results of matrix and fail on a regression."""
+    import json
+
+    with open(args.baseline) as input_file:
+        baseline = json.load(input_file)
+    with open(args.current) as input_file:
+        current = json.load(input_file)
+
+    if [entry['sha256'] for entry in baseline['corpus']] != [
+            entry['sha256'] for entry in current['corpus']]:
+        print('the results were measured on different corpora',
+              file=sys.stderr)
+        return 2
+
+    def scenarios(results):
+        return {json.dumps(result['options'], sort_keys=True): result
+                for result in results['results']}
+
+    baseline_scenarios = scenarios(baseline)
+    current_scenarios = scenarios(current)
+
+    print('{:<24} {:>9} {:>9} {:>8} {:>17}  {}'.format(
+        'options', 'base (s)', 'new (s)', 'change', 'interval', 'status'))
+    regressions = 0
+    for (key, base_result) in sorted(baseline_scenarios.items()):
+        name = scenario_name(base_result['options'])
+        if key not in current_scenarios:
+            print('{:<24} missing from {}'.format(name, args.current))
+            continue
+
+        new_result = current_scenarios[key]
+        ratio = (sum(new_result['latencies']) /
+                 sum(base_result['latencies']))
+        (low, high) = bootstrap_ratio(base_result['latencies'],
+                                      new_result['latencies'],
+                                      args.confidence, args.resamples)
+        if low > 1 + args.threshold:
+            status = 'regressed'
+            regressions += 1
+        elif high < 1 - args.threshold:
+            status = 'improved'
+        else:
+            status = 'ok'
+
+        print('{:<24} {:>9.3f} {:>9.3f} {:>+7.1%} [{:>+6.1%}, {:>+6.1%}]  '
+              '{}'.format(name, base_result['seconds'],
+                          new_result['seconds'], ratio - 1, low - 1,
+                          high - 1, status))
+
+    return 1 if regressions else 0
+
+
+def process_args():
+    """Return processed arguments."""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_overhead = subparsers.add_parser(
+        'overhead', help=per_file_overhead.__doc__)
+    parser_overhead.add_argument('-a', '--aggressive', action='count',
+                                 default=0)
+    parser_overhead.add_argument('-n', '--number', type=int, default=200,
+                                 help='files per measurement')
+    parser_overhead.add_argument('-r', '--repeat', type=int, default=5,
+                                 help='number of measurements')
+    parser_overhead.set_defaults(function=per_file_overhead)
+
+    parser_daemon = subparsers.add_parser(
+        'daemon', help=daemon_latency.__doc__)
+    parser_daemon.add_argument('-n', '--number', type=int, default=10,
+                               help='files per measurement')
+    parser_daemon.add_argument('-r', '--repeat', type=int, default=3,
+                               help='number of measurements')
+    parser_daemon.set_defaults(function=daemon_latency)
+
+    parser_scheduler = subparsers.add_parser(
+        'scheduler', help=scheduler_throughput.__doc__)
+    parser_scheduler.add_argument('-f', '--files', type=int, default=2000,
+                                  help='number of files')
+    parser_scheduler.add_argument('-j', '--jobs', type=int, default=4,
+                                  help='number of parallel jobs')
+    parser_scheduler.add_argument('-r', '--repeat', type=int, default=3,
+                                  help='number of measurements')
+    parser_scheduler.set_defaults(function=scheduler_throughput)
+
+    parser_prune = subparsers.add_parser('prune', help=prune_speedup.__doc__)
+    parser_prune.add_argument('-a', '--aggressive', action='count',
+                              default=0)
+    parser_prune.add_argument('-f', '--files', type=int, default=200,
+                              help='number of files')
+    parser_prune.set_defaults(function=prune_speedup)
+
+    parser_ranges = subparsers.add_parser('ranges',
+                                          help=line_range_cost.__doc__)
+    parser_ranges.add_argument('-a', '--aggressive', action='count',
+                               default=0)
+    parser_ranges.add_argument('-f', '--files', type=int, default=50,
+                               help='number of files')
+    parser_ranges.add_argument('-l', '--lines', type=int, default=10,
+                               help='number of lines to format per file')
+    parser_ranges.set_defaults(function=line_range_cost)
+
+    parser_split = subparsers.add_parser('split', help=split_speedup.__doc__)
+    parser_split.add_argument('-a', '--aggressive', action='count',
+                              default=0)
+    parser_split.add_argument('-l', '--lines', type=int, default=100000,
+                              help='number of lines of the module')
+    parser_split.add_argument('-j', '--jobs', type=int, default=4,
+                              help='number of parallel jobs')
+    parser_split.set_defaults(function=split_speedup)
+
+    parser_encoding = subparsers.add_parser(
+        'encoding', help=encoding_detection.__doc__)
+    parser_encoding.add_argument('-f', '--files', type=int, default=200,
+                                 help='number of files to derive the corpus '
+                                      'from')
+    parser_encoding.add_argument('-r', '--repeat', type=int, default=5,
+                                 help='number of measurements')
+    parser_encoding.set_defaults(function=encoding_detection)
+
+    parser_unchanged = subparsers.add_parser(
+        'unchanged', help=unchanged_files.__doc__)
+    parser_unchanged.add_argument('-f', '--files', type=int, default=10000,
+                                  help='number of files')
+    parser_unchanged.add_argument('--changed-every', type=int, default=100,
+                                  metavar='n',
+                                  help='make every nth file need formatting')
+    parser_unchanged.add_argument('-j', '--jobs', type=int, default=4,
+                                  help='number of parallel jobs that fill '
+                                       'the cache')
+    parser_unchanged.add_argument('-r', '--repeat', type=int, default=3,
+                                  help='number of measurements')
+    parser_unchanged.set_defaults(function=unchanged_files)
+
+    parser_discovery = subparsers.add_parser(
+        'discovery', help=discovery_speed.__doc__)
+    parser_discovery.add_argument('-e', '--entries', type=int,
+                                  default=200000,
+                                  help='number of files in the tree')
+    parser_discovery.add_argument('--excluded', type=float, default=0.9,
+                                  help='share of files in excluded '
+                                       'directories')
+    parser_discovery.add_argument('-j', '--jobs', type=int, default=4,
+                                  help='number of threads')
+    parser_discovery.add_argument('-r', '--repeat', type=int, default=3,
+                                  help='number of measurements')
+    parser_discovery.set_defaults(function=discovery_speed)
+
+    parser_gitignore = subparsers.add_parser(
+        'gitignore', help=gitignore_speed.__doc__)
+    parser_gitignore.add_argument('-f', '--files', type=int, default=10000,
+                                  help='number of files that are not '
+                                       'ignored')
+    parser_gitignore.add_argument('-i', '--ignored', type=int,
+                                  default=500000,
+                                  help='number of ignored files')
+    parser_gitignore.add_argument('-r', '--repeat', type=int, default=3,
+                                  help='number of measurements')
+    parser_gitignore.set_defaults(function=gitignore_speed)
+
+    parser_git_index = subparsers.add_parser(
+        'git-index', help=git_index_check.__doc__)
+    parser_git_index.add_argument('-f', '--files', type=int, default=40000,
+                                  help='number of files in the repository')
+    parser_git_index.add_argument('-j', '--jobs', type=int, default=1,
+                                  help='number of parallel jobs')
+    parser_git_index.add_argument('-r', '--repeat', type=int, default=3,
+                                  help='number of measurements')
+    parser_git_index.set_defaults(function=git_index_check)
+
+    parser_clean_tree = subparsers.add_parser(
+        'clean-tree', help=clean_tree_check.__doc__)
+    parser_clean_tree.add_argument('-f', '--files', type=int, default=40000,
+                                   help='number of files in the tree')
+    parser_clean_tree.add_argument('-r', '--repeat', type=int, default=3,
+                                   help='number of measurements')
+    parser_clean_tree.set_defaults(function=clean_tree_check)
+
+    parser_matrix = subparsers.add_parser(
+        'matrix', help=option_matrix_throughput.__doc__)
+    parser_matrix.add_argument('-f', '--files', type=int, default=100,
+                               help='number of files in the corpus')
+    parser_matrix.add_argument('--max-size', type=int, default=64 * 1024,
+                               help='largest file in the corpus in bytes')
+    parser_matrix.add_argument('--seed', type=int, default=0,
+                               help='seed of the corpus sample')
+    parser_matrix.add_argument('-r', '--repeat', type=int, default=3,
+                               help='number of times to format the corpus')
+    parser_matrix.add_argument('-o', '--output', metavar='path',
+                               help='write results to path as JSON')
+    parser_matrix.set_defaults(function=option_matrix_throughput)
+
+    parser_compare = subparsers.add_parser('compare',
+                                           help=compare_results.__doc__)
+    parser_compare.add_argument('baseline', help='JSON results of matrix')
+    parser_compare.add_argument('current', help='JSON results of matrix')
+    parser_compare.add_argument('-t', '--threshold', type=float, default=0.05,
+                                help='relative slowdown that is tolerated '
+                                     '(default: %(default)s)')
+    parser_compare.add_argument('-c', '--confidence', type=float,
+                                default=0.95,
+                                help='confidence level of the intervals '
+                                     '(default: %(default)s)')
+    parser_compare.add_argument('--resamples', type=int, default=2000,
+                                help='number of bootstrap resamples')
+    parser_compare.set_defaults(function=compare_results)
+
+    return parser.parse_args()
+
+
+def main():
+    """Run main."""
+    args = process_args()
+    return args.function(args) or 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(1)
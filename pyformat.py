@@ -28,36 +28,142 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import codecs
+import collections
+import functools
 import io
-from pathlib import Path
+import os
+import re
 import signal
 import sys
+import time
 from typing import Tuple
 
-from add_trailing_comma._main import _fix_src as add_trailing_comma_to_code
-import autoflake
-import autopep8
-import docformatter
-import inspect
-import isort
-import unify
-
 
 __version__ = '1.0a0'
 
+# Maximum number of distinct option combinations whose pipelines are kept.
+PIPELINE_CACHE_SIZE = 64
+
+# Size in bytes above which least recently used result cache entries are
+# evicted.
+DEFAULT_CACHE_SIZE = 128 * 1024 * 1024
+
+# Seconds between scans of the result cache for entries to evict, and the
+# file in the cache directory whose modification time records the last one.
+PRUNE_INTERVAL = 60 * 60
+PRUNE_STAMP_FILENAME = 'last-prune'
+
+# Coding cookie and blank line as in PEP 263, matched on each of the first two
+# lines of source.
+CODING_COOKIE_REGEX = re.compile(br'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)',
+                                 re.ASCII)
+BLANK_LINE_REGEX = re.compile(br'^[ \t\f]*(?:[#\r\n]|$)')
+
+# Options of format_code() that clients may send to the daemon.
+DAEMON_OPTIONS = ('aggressive', 'apply_config', 'filename',
+                  'remove_all_unused_imports', 'remove_unused_variables',
+                  'sort_imports', 'add_trailing_comma', 'line_ranges',
+                  'max_passes')
+
+# Number of tasks per parallel job that may be in flight. Output of finished
+# tasks is held back until all earlier files have been written, so this also
+# bounds the amount of buffered output.
+PENDING_TASKS_PER_JOB = 4
+
+# Files are grouped into one parallel task until their total size reaches
+# CHUNK_BYTES or the task holds MAX_CHUNK_LENGTH files.
+CHUNK_BYTES = 32 * 1024
+MAX_CHUNK_LENGTH = 8
+
+# Number of characters of parallel output that may be held back waiting for
+# an earlier file before files are submitted in input order.
+MAX_HELD_OUTPUT = 16 * 1024 * 1024
+
+# Name of the file in the cache directory that records how long each file
+# took to format, used to submit the longest files first.
+DURATIONS_FILENAME = 'durations.json'
+
+# Prefix of the names of stat index files in the cache directory.
+STAT_INDEX_PREFIX = 'stat-index-'
+
+# Bytes a stat index journal grows to before it is folded into the index.
+# Until then each run reads the journal in full, which is cheap, instead of
+# rewriting the whole index.
+STAT_JOURNAL_MAX_SIZE = 256 * 1024
+
+# Files modified less than this many nanoseconds before they were examined
+# are not recorded in the stat index, since a change within the timestamp
+# resolution of the file system would leave their stat results unchanged.
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+# Seconds without further changes that watch_files() waits for before
+# formatting changed files, so that a burst of saves is formatted once.
+WATCH_DEBOUNCE = 0.2
+
+# Files without a .py extension are formatted if their first line, within
+# this many bytes, is a Python shebang.
+MAX_SHEBANG_BYTES = 1024
+PYTHON_SHEBANG_REGEX = re.compile(r'^#!.*\bpython[23]?\b\s*$')
+
+# Features of the source (see source_features()) that a formatter acts on. A
+# stage is skipped if none of the features of its formatter are present.
+# Formatters that are not listed always run.
+STAGE_FEATURES = {
+    'autoflake': frozenset(['import', 'pass']),
+    'add_trailing_comma': frozenset(['multiline_brackets', 'trailing_comma']),
+    'docformatter': frozenset(['string']),
+    'unify': frozenset(['double_quoted_string']),
+    'isort': frozenset(['import']),
+}
+
+# Formatters that need the whole source, such as autoflake, which removes
+# imports that are unused anywhere in it, and docformatter, whose handling of
+# a string depends on the code around it. The other formatters give the same
+# result on the parts of a source split by split_source().
+WHOLE_SOURCE_STAGES = ('autoflake', 'docformatter', 'isort')
+
+# Number of parts per parallel job that format_code_in_parallel() splits a
+# source into, so that parts of uneven cost still keep every job busy.
+SPLIT_PARTS_PER_JOB = 4
+
+# Distributions whose versions affect formatting results.
+FORMATTER_DISTRIBUTIONS = ('autoflake', 'autopep8', 'docformatter', 'unify',
+                           'isort', 'add-trailing-comma')
+
+# Configuration files that the formatters read from a directory or its
+# parents: autopep8 from those of the file with --config, docformatter and
+# isort from those of the working directory. The global ones are read by
+# autopep8 with --config from the user's configuration directory.
+CONFIG_FILENAMES = ('setup.cfg', 'tox.ini', '.pep8', '.flake8',
+                    'pyproject.toml', '.isort.cfg', '.editorconfig')
+GLOBAL_CONFIG_FILENAMES = ('pep8', 'pycodestyle')
+
 
 def formatters(aggressive, apply_config, filename='',
                remove_all_unused_imports=False, remove_unused_variables=False,
                sort_imports=False,
                add_trailing_comma=False):
-    """Return list of code formatters."""
+    """Return list of code formatters.
+
+    Formatter modules are imported only when a stage using them is built.
+    """
+    import autopep8
+    import docformatter
+    import inspect
+    import unify
+
     if aggressive:
-        yield lambda code: autoflake.fix_code(
-            code,
+        import autoflake
+        yield functools.partial(
+            autoflake.fix_code,
             remove_all_unused_imports=remove_all_unused_imports,
             remove_unused_variables=remove_unused_variables)
         if add_trailing_comma:
-            yield lambda code: add_trailing_comma_to_code(code, min_version=(3, 6))
+            from add_trailing_comma._main import _fix_src as \
+                add_trailing_comma_to_code
+            yield functools.partial(add_trailing_comma_to_code,
+                                    min_version=(3, 6))
 
         autopep8_options = autopep8.parse_args(
             [filename] + int(aggressive) * ['--aggressive'],
@@ -66,7 +172,7 @@ def formatters(aggressive, apply_config, filename='',
         autopep8_options = autopep8.parse_args(
             [filename], apply_config=apply_config)
 
-    yield lambda code: autopep8.fix_code(code, options=autopep8_options)
+    yield functools.partial(autopep8.fix_code, options=autopep8_options)
     if any(x[0]=='Formatter' for x in inspect.getmembers(docformatter)):
         configurator = docformatter.Configurater(["docformatter","-"])
         configurator.do_parse_arguments()
@@ -75,76 +181,1505 @@ def formatters(aggressive, apply_config, filename='',
         yield docformatter.format_code
     yield unify.format_code
     if sort_imports:
-        yield _format_by_isort
+        yield functools.partial(_format_by_isort, config=_isort_config())
 
 
-def _format_by_isort(code):
+def _isort_config():
+    from pathlib import Path
+    import isort
     config_dict = {
         'settings_path': Path('.').resolve().absolute()
     }
-    config = isort.Config(**config_dict)
+    return isort.Config(**config_dict)
+
+
+def _format_by_isort(code, config=None):
+    import isort
+    if config is None:
+        config = _isort_config()
     return isort.code(code=code, config=config)
 
 
+class Pipeline(object):
+
+    """Chain of code formatters built once for a set of options.
+
+    stages is a sequence of formatters or a function that returns them,
+    which is called when they are first needed. fingerprint describes what
+    the stages do, if known before they are built.
+    """
+
+    def __init__(self, stages, fingerprint=None):
+        self._stages = stages if callable(stages) else tuple(stages)
+        self._names = None
+        self._features = None
+        self._fingerprint = fingerprint
+
+    @property
+    def stages(self):
+        if callable(self._stages):
+            self._stages = tuple(self._stages())
+        return self._stages
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = tuple(_stage_name(fix) for fix in self.stages)
+        return self._names
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = tuple(_stage_features(fix)
+                                   for fix in self.stages)
+        return self._features
+
+    def __call__(self, source, profile=None, prune=True, line_ranges=None):
+        """Return source after running it through every stage.
+
+        If prune is true, stages that cannot change the source because it
+        lacks the features they act on are skipped.
+
+        If profile is a dictionary, the wall time, CPU time and whether the
+        stage changed the source are added to it for each stage.
+
+        If line_ranges is given, only lines in those (first, last) ranges of
+        line numbers are formatted. Stages that support it are told the
+        range; the changes of the others are discarded outside of it.
+        """
+        if line_ranges is not None:
+            line_ranges = _normalize_line_ranges(line_ranges)
+            if not line_ranges:
+                return source
+
+        stages = (self._needed_stages(source, line_ranges) if prune
+                  else self.stages)
+
+        if profile is not None or line_ranges is not None:
+            return self._run(source, stages, profile, line_ranges)
+
+        for fix in stages:
+            source = fix(source)
+        return source
+
+    def _needed_stages(self, source, line_ranges=None):
+        if all(features is None for features in self.features):
+            return self.stages
+
+        if line_ranges is not None:
+            # Insertions next to a range count as changes in it.
+            line_ranges = [(first - 1, last + 1)
+                           for (first, last) in line_ranges]
+
+        present = source_features(source, line_ranges)
+        if present is None:
+            return self.stages
+
+        return [fix for (fix, features) in zip(self.stages, self.features)
+                if features is None or features & present]
+
+    def _run(self, source, stages, profile, line_ranges):
+        for (name, fix) in zip(self.names, self.stages):
+            if fix not in stages:
+                if profile is not None:
+                    record = profile.setdefault(name, _new_profile_record())
+                    record['skipped'] += 1
+                continue
+
+            start_wall_time = time.perf_counter()
+            start_cpu_time = time.process_time()
+            if line_ranges is None:
+                formatted_source = fix(source)
+            else:
+                if not line_ranges:
+                    break
+                formatted_source = _restrict_stage(
+                    fix, line_ranges[0][0], line_ranges[-1][1])(source)
+                (formatted_source, line_ranges) = _keep_changes_in_ranges(
+                    source, formatted_source, line_ranges)
+            if profile is not None:
+                record = profile.setdefault(name, _new_profile_record())
+                record['calls'] += 1
+                record['changed'] += formatted_source != source
+                record['wall_time'] += time.perf_counter() - start_wall_time
+                record['cpu_time'] += time.process_time() - start_cpu_time
+            source = formatted_source
+        return source
+
+    def split(self):
+        """Return pipelines of the leading, middle and trailing stages.
+
+        Only the middle stages may be run on parts of a source. They are
+        those up to the first stage after the leading ones that needs the
+        whole source. Return None if there are no middle stages.
+        """
+        whole = [name in WHOLE_SOURCE_STAGES for name in self.names]
+        start = 0
+        while start < len(whole) and whole[start]:
+            start += 1
+        stop = start
+        while stop < len(whole) and not whole[stop]:
+            stop += 1
+        if stop == start:
+            return None
+        return (Pipeline(self.stages[:start]),
+                Pipeline(self.stages[start:stop]),
+                Pipeline(self.stages[stop:]))
+
+    @property
+    def fingerprint(self):
+        """Return digest of the stages, their options and formatter versions.
+
+        Two pipelines with the same fingerprint produce the same output.
+        Unless given, the digest describes the stages as they are when it is
+        first asked for, which must be before they run.
+        """
+        if self._fingerprint is None:
+            import hashlib
+            description = repr((__version__,
+                                formatter_versions(),
+                                [_describe(fix) for fix in self.stages]))
+            self._fingerprint = hashlib.sha256(
+                description.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+
+def _stage_name(fix):
+    """Return name of the formatter behind a stage."""
+    while isinstance(fix, functools.partial):
+        fix = fix.func
+    if fix is _format_by_isort:
+        return 'isort'
+    fix = getattr(fix, '__func__', fix)
+    return fix.__module__.split('.')[0]
+
+
+def _stage_features(fix):
+    """Return features a stage acts on or None if it must always run."""
+    keywords = getattr(fix, 'keywords', {})
+    if keywords.get('remove_unused_variables'):
+        return None
+    return STAGE_FEATURES.get(_stage_name(fix))
+
+
+def source_features(source, line_ranges=None):
+    """Return features of source that formatters act on.
+
+    If line_ranges is given, only tokens on lines in those (first, last)
+    ranges count. Return None if source cannot be tokenized.
+    """
+    import tokenize
+
+    string_types = {tokenize.STRING}
+    if hasattr(tokenize, 'FSTRING_START'):
+        string_types.add(tokenize.FSTRING_START)
+
+    features = set()
+    # Features of tokens outside of line_ranges are collected here.
+    ignored_features = set()
+    found = features
+    depth = 0
+    previous_string = None
+    previous_row = 1
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            (token_type, token_string, start, end, _) = token
+            if line_ranges is not None:
+                found = features if any(
+                    first <= end[0] and start[0] <= last
+                    for (first, last) in line_ranges) else ignored_features
+
+            # Brackets also span lines through backslash continuations,
+            # which produce no NL token.
+            if depth > 0 and (start[0] != end[0] or start[0] != previous_row):
+                found.add('multiline_brackets')
+
+            if token_type == tokenize.NAME:
+                if token_string in ('import', 'pass'):
+                    found.add(token_string)
+            elif token_type in string_types:
+                found.add('string')
+                quotes = token_string.lstrip('bBfFrRuU')
+                if quotes.startswith('"') and not quotes.startswith('"""'):
+                    found.add('double_quoted_string')
+            elif token_type == tokenize.OP:
+                if token_string in '([{':
+                    depth += 1
+                elif token_string in ')]}':
+                    depth -= 1
+                    if previous_string == ',':
+                        found.add('trailing_comma')
+            elif token_type == tokenize.COMMENT:
+                # docformatter recognizes docstrings by lines ending in quotes.
+                if '"""' in token_string:
+                    found.add('string')
+            elif token_type == tokenize.NL and depth > 0:
+                found.add('multiline_brackets')
+
+            if token_type not in (tokenize.NL, tokenize.COMMENT):
+                previous_string = token_string
+            previous_row = end[0]
+    except (SyntaxError, tokenize.TokenError):
+        return None
+
+    return features
+
+
+def _normalize_line_ranges(line_ranges):
+    """Return sorted list of disjoint (first, last) line number ranges."""
+    normalized = []
+    for (first, last) in sorted((max(int(first), 1), int(last))
+                                for (first, last) in line_ranges):
+        if last < first:
+            continue
+        if normalized and first <= normalized[-1][1] + 1:
+            normalized[-1] = (normalized[-1][0], max(normalized[-1][1], last))
+        else:
+            normalized.append((first, last))
+    return normalized
+
+
+def _restrict_stage(fix, first_line, last_line):
+    """Return stage that only formats lines first_line to last_line.
+
+    Stages whose formatter has no option for this are returned unchanged.
+    """
+    import copy
+    import inspect
+
+    name = _stage_name(fix)
+    if name == 'autopep8':
+        # autopep8 updates the range in place, so each call gets a copy.
+        options = copy.copy(fix.keywords['options'])
+        options.line_range = [first_line, last_line]
+        return functools.partial(fix.func, *fix.args,
+                                 **dict(fix.keywords, options=options))
+    if name == 'docformatter':
+        if inspect.ismethod(fix):
+            formatter = copy.copy(fix.__self__)
+            formatter.args = copy.copy(formatter.args)
+            formatter.args.line_range = [first_line, last_line]
+            return getattr(formatter, fix.__name__)
+        return functools.partial(fix, line_range=[first_line, last_line])
+    return fix
+
+
+def _keep_changes_in_ranges(source, formatted_source, line_ranges):
+    """Return formatted_source with changes outside of line_ranges undone.
+
+    Changes are kept or undone line by line where lines were replaced one
+    for one and as whole blocks of differing lines otherwise. If lines were
+    moved, as isort and autopep8 do with imports, undoing only some of the
+    changes would lose or duplicate them, so all changes are kept if each
+    touches line_ranges and all are undone otherwise. Also return the line
+    ranges of the result that hold the original ranges and the kept
+    changes.
+    """
+    if formatted_source == source:
+        return (source, line_ranges)
+
+    import difflib
+
+    lines = source.splitlines(True)
+    formatted_lines = formatted_source.splitlines(True)
+
+    touched = [False] * len(lines)
+    for (first, last) in line_ranges:
+        touched[first - 1:last] = [True] * len(touched[first - 1:last])
+
+    matcher = difflib.SequenceMatcher(None, lines, formatted_lines,
+                                      autojunk=False)
+    opcodes = matcher.get_opcodes()
+    hunks = [(i1, i2, j1, j2) for (tag, i1, i2, j1, j2) in opcodes
+             if tag != 'equal']
+    keep_all = False
+    if _moves_lines(lines, formatted_lines, hunks):
+        if not all(_touches(touched, i1, i2) for (i1, i2, _, _) in hunks):
+            return (source, line_ranges)
+        keep_all = True
+
+    result = []
+    result_touched = []
+    for (tag, i1, i2, j1, j2) in opcodes:
+        if tag == 'replace' and i2 - i1 == j2 - j1 and not keep_all:
+            for (i, j) in zip(range(i1, i2), range(j1, j2)):
+                result.append(formatted_lines[j] if touched[i] else lines[i])
+            result_touched.extend(touched[i1:i2])
+            continue
+
+        if tag == 'equal':
+            keep = False
+        else:
+            keep = keep_all or _touches(touched, i1, i2)
+
+        if keep:
+            result.extend(formatted_lines[j1:j2])
+            result_touched.extend([True] * (j2 - j1))
+        else:
+            result.extend(lines[i1:i2])
+            result_touched.extend(touched[i1:i2])
+
+    new_ranges = []
+    for (number, is_touched) in enumerate(result_touched, 1):
+        if not is_touched:
+            continue
+        if new_ranges and new_ranges[-1][1] == number - 1:
+            new_ranges[-1] = (new_ranges[-1][0], number)
+        else:
+            new_ranges.append((number, number))
+
+    return (''.join(result), new_ranges)
+
+
+def _touches(touched, first, stop):
+    """Return True if a change of lines first to stop touches the ranges.
+
+    Insertions touch the ranges if a line next to them is in one.
+    """
+    if first == stop:
+        return any(touched[max(first - 1, 0):first + 1])
+    return any(touched[first:stop])
+
+
+def _moves_lines(lines, formatted_lines, hunks):
+    """Return True if a line removed by one hunk is added by another."""
+    removed = {}
+    for (number, (i1, i2, _, _)) in enumerate(hunks):
+        for line in lines[i1:i2]:
+            if line.strip():
+                removed.setdefault(line.strip(), set()).add(number)
+    for (number, (_, _, j1, j2)) in enumerate(hunks):
+        for line in formatted_lines[j1:j2]:
+            if removed.get(line.strip(), {number}) - {number}:
+                return True
+    return False
+
+
+def _new_profile_record():
+    return {'calls': 0, 'changed': 0, 'skipped': 0,
+            'wall_time': 0.0, 'cpu_time': 0.0}
+
+
+def merge_profiles(total, profile):
+    """Add the stage records of profile to total."""
+    for (name, record) in profile.items():
+        total_record = total.setdefault(name, _new_profile_record())
+        for (key, value) in record.items():
+            total_record[key] += value
+
+
+def format_profile(profile):
+    """Return stage profile as a table."""
+    lines = ['{:<20} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+        'stage', 'calls', 'changed', 'skipped', 'wall (s)', 'cpu (s)')]
+    for (name, record) in profile.items():
+        lines.append('{:<20} {:>8} {:>8} {:>8} {:>10.3f} {:>10.3f}'.format(
+            name, record['calls'], record['changed'], record['skipped'],
+            record['wall_time'], record['cpu_time']))
+    return '\n'.join(lines) + '\n'
+
+
+def _describe(value):
+    """Return a representation of value that is stable across processes."""
+    import argparse
+    import dataclasses
+    import inspect
+    if isinstance(value, functools.partial):
+        return ('partial', _describe(value.func), _describe(value.args),
+                _describe(value.keywords))
+    if inspect.ismethod(value):
+        return ('method', _describe(value.__func__),
+                _describe(vars(value.__self__)))
+    if inspect.isfunction(value) or inspect.isbuiltin(value):
+        return value.__module__ + '.' + value.__qualname__
+    if isinstance(value, argparse.Namespace):
+        # The file list only locates configuration files, whose effect is
+        # already reflected in the other options.
+        return _describe({key: item for key, item in vars(value).items()
+                          if key != 'files'})
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return _describe({field.name: getattr(value, field.name)
+                          for field in dataclasses.fields(value)})
+    if isinstance(value, dict):
+        return sorted((repr(key), _describe(item))
+                      for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(repr(_describe(item)) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [_describe(item) for item in value]
+    if type(value).__repr__ is object.__repr__:
+        # The default representation contains the memory address.
+        return type(value).__module__ + '.' + type(value).__qualname__
+    return repr(value)
+
+
+@functools.lru_cache(maxsize=None)
+def formatter_versions():
+    """Return versions of the formatter distributions."""
+    import importlib.metadata
+    versions = []
+    for name in FORMATTER_DISTRIBUTIONS:
+        try:
+            versions.append((name, importlib.metadata.version(name)))
+        except importlib.metadata.PackageNotFoundError:
+            versions.append((name, None))
+    return tuple(versions)
+
+
+def get_pipeline(aggressive=False, apply_config=False, filename='',
+                 remove_all_unused_imports=False,
+                 remove_unused_variables=False, sort_imports=False,
+                 add_trailing_comma=False):
+    """Return a cached Pipeline for the given options.
+
+    Only the directory of filename matters (for finding configuration files)
+    and only when apply_config is set. docformatter and isort read their
+    settings relative to the working directory. Pipelines are cached by
+    fingerprint, so directories with the same configuration files share
+    one.
+    """
+    options = (int(aggressive),
+               bool(apply_config),
+               _config_directory(filename) if apply_config else '',
+               bool(remove_all_unused_imports),
+               bool(remove_unused_variables),
+               bool(sort_imports),
+               bool(add_trailing_comma),
+               os.getcwd())
+    fingerprint = _options_fingerprint(*options)
+    pipeline = _pipelines.get(fingerprint)
+    if pipeline is None:
+        pipeline = _build_pipeline(*options, fingerprint=fingerprint)
+        _pipelines[fingerprint] = pipeline
+        while len(_pipelines) > PIPELINE_CACHE_SIZE:
+            _pipelines.popitem(last=False)
+    else:
+        try:
+            _pipelines.move_to_end(fingerprint)
+        except KeyError:
+            # Evicted by another thread in the meantime.
+            pass
+    return pipeline
+
+
+# Pipelines by fingerprint, least recently used first.
+_pipelines = collections.OrderedDict()
+
+
+def _config_directory(filename):
+    """Return directory where configuration lookup for filename starts."""
+    if not filename:
+        return os.path.abspath('')
+    return os.path.dirname(os.path.abspath(filename))
+
+
+def _build_pipeline(aggressive, apply_config, config_directory,
+                    remove_all_unused_imports, remove_unused_variables,
+                    sort_imports, add_trailing_comma, working_directory,
+                    fingerprint):
+    # The stages are built when first needed, so looking up results by the
+    # fingerprint does not import the formatters. A trailing separator makes
+    # autopep8 start its configuration search in config_directory.
+    return Pipeline(
+        functools.partial(
+            formatters, aggressive, apply_config,
+            os.path.join(config_directory, ''), remove_all_unused_imports,
+            remove_unused_variables, sort_imports, add_trailing_comma),
+        fingerprint=fingerprint)
+
+
+def _forget_configuration():
+    """Make pipelines read configuration files again when they change.
+
+    Long-running processes call this before formatting files of another
+    request or change.
+    """
+    _config_files.cache_clear()
+    _global_config_files.cache_clear()
+    _options_fingerprint.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _options_fingerprint(aggressive, apply_config, config_directory,
+                         remove_all_unused_imports, remove_unused_variables,
+                         sort_imports, add_trailing_comma, working_directory):
+    """Return fingerprint of the pipeline built for the given options.
+
+    It digests the options, the formatter versions and the configuration
+    files the formatters read, without importing the formatters.
+    """
+    import hashlib
+    description = repr((
+        __version__,
+        formatter_versions(),
+        (aggressive, apply_config, remove_all_unused_imports,
+         remove_unused_variables, sort_imports, add_trailing_comma),
+        (_config_files(config_directory), _global_config_files())
+        if apply_config else None,
+        _config_files(working_directory),
+        # isort tells first-party modules by looking for them there.
+        working_directory if sort_imports else None))
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _config_files(directory):
+    """Return digests of the configuration files of directory and parents.
+
+    There is a tuple of (name, digest) pairs per directory, starting with
+    directory. Directories above the last one with configuration files are
+    left out, so that copies of a tree have equal results.
+    """
+    parent = os.path.dirname(directory)
+    files = (_config_files(parent)
+             if parent and parent != directory else ())
+    found = tuple((name, _file_digest(os.path.join(directory, name)))
+                  for name in CONFIG_FILENAMES)
+    found = tuple((name, digest) for (name, digest) in found
+                  if digest is not None)
+    if not found and not files:
+        return ()
+    return (found,) + files
+
+
+@functools.lru_cache(maxsize=None)
+def _global_config_files():
+    """Return digests of the user's configuration files for autopep8."""
+    directory = (os.environ.get('XDG_CONFIG_HOME') or
+                 os.path.join(os.path.expanduser('~'), '.config'))
+    paths = ([os.path.join(directory, name)
+              for name in GLOBAL_CONFIG_FILENAMES] +
+             [os.path.join(os.path.expanduser('~'), '.' + name)
+              for name in GLOBAL_CONFIG_FILENAMES])
+    return tuple((path, _file_digest(path)) for path in paths)
+
+
+def _file_digest(path):
+    """Return digest of the contents of file path or None if unreadable."""
+    import hashlib
+    try:
+        with open(path, 'rb') as input_file:
+            return hashlib.sha256(input_file.read()).hexdigest()
+    except OSError:
+        return None
+
+
 def format_code(source, aggressive=False, apply_config=False, filename='',
                 remove_all_unused_imports=False,
                 remove_unused_variables=False, sort_imports=False,
-                add_trailing_comma=False):
-    """Return formatted source code."""
-    formatted_source = source
+                add_trailing_comma=False, profile=None, line_ranges=None,
+                max_passes=1):
+    """Return formatted source code.
+
+    If profile is a dictionary, per-stage timings are added to it.
+
+    If line_ranges is given, only lines in those (first, last) ranges of
+    line numbers are formatted.
+
+    The formatters are run up to max_passes times, until a pass leaves the
+    code unchanged. This cannot be combined with line_ranges.
+    """
+    if line_ranges is not None and max_passes > 1:
+        raise ValueError('line_ranges cannot be used with max_passes')
+
+    pipeline = get_pipeline(
+        aggressive, apply_config, filename,
+        remove_all_unused_imports, remove_unused_variables, sort_imports,
+        add_trailing_comma)
+    return iterate_to_fixpoint(
+        functools.partial(pipeline, profile=profile, line_ranges=line_ranges),
+        source, max_passes)[0]
+
+
+def iterate_to_fixpoint(function, source, max_passes):
+    """Apply function to source until it stops changing the source.
+
+    Return the result, the number of passes made and whether the last pass
+    left the source unchanged. No more than max_passes passes are made.
+    """
+    for passes in range(1, max(max_passes, 1) + 1):
+        formatted_source = function(source)
+        if formatted_source == source:
+            return (source, passes, True)
+        source = formatted_source
+    return (source, passes, False)
+
+
+def format_code_in_parallel(source, jobs, profile=None, **options):
+    """Return source formatted like format_code() but by jobs processes.
+
+    The source is split into parts at top-level definitions by
+    split_source(). Stages that need the whole source run on it before and
+    after the others run on the parts in parallel. options are those of
+    format_code().
+    """
+    import multiprocessing
+
+    pipeline = get_pipeline(**options)
+    stages = pipeline.split()
+    if jobs <= 1 or stages is None or multiprocessing.current_process().daemon:
+        # Pool workers cannot start processes of their own.
+        return pipeline(source, profile=profile)
+
+    (head, middle, tail) = stages
+    source = head(source, profile=profile)
+
+    parts = split_source(source, jobs * SPLIT_PARTS_PER_JOB)
+    if len(parts) > 1:
+        with multiprocessing.Pool(min(jobs, len(parts)),
+                                  initializer=_initialize_worker,
+                                  initargs=(None,)) as pool:
+            results = pool.map(_format_part,
+                               [(part, options, profile is not None)
+                                for part in parts],
+                               chunksize=1)
+        for (_, part_profile) in results:
+            if part_profile:
+                merge_profiles(profile, part_profile)
+        source = join_source([part for (part, _) in results])
+    else:
+        source = middle(source, profile=profile)
+
+    return tail(source, profile=profile)
+
+
+def _format_part(parameters):
+    """Return part formatted by the middle stages and its stage profile."""
+    (part, options, profiling) = parameters
+    profile = {} if profiling else None
+    middle = get_pipeline(**options).split()[1]
+    return (middle(part, profile=profile), profile)
+
+
+def split_source(source, parts):
+    """Return source split into at most parts pieces of similar length.
+
+    Pieces start at a top-level def or class, or at the first decorator in
+    front of one, that comes after the last top-level import and after a
+    blank line preceded by code. The formatters only put two blank lines in
+    front of such a definition, so formatting the pieces separately and
+    joining them with join_source() gives the same result as formatting the
+    source. Pieces do not start within regions where autopep8 is turned
+    off. Return [source] if it cannot be split.
+    """
+    import autopep8
+    import tokenize
+
+    if parts <= 1 or '\r' in source:
+        return [source]
 
-    for fix in formatters(
-            aggressive, apply_config, filename,
-            remove_all_unused_imports, remove_unused_variables, sort_imports,
-            add_trailing_comma):
-        formatted_source = fix(formatted_source)
+    lines = source.splitlines(True)
+    definitions = []
+    last_import = 0
+    at_statement_start = True
+    decorated = False
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            (token_type, token_string, start, _, _) = token
+            if token_type == tokenize.NEWLINE:
+                at_statement_start = True
+                continue
+            if token_type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT,
+                              tokenize.DEDENT, tokenize.ENDMARKER):
+                continue
+
+            if at_statement_start and start[1] == 0:
+                if token_string in ('import', 'from'):
+                    last_import = start[0]
+                elif (
+                    token_string in ('def', 'class', 'async', '@') and
+                    not decorated
+                ):
+                    definitions.append(start[0])
+                # Blank lines between a decorator and its definition are
+                # removed, so they cannot be split apart.
+                decorated = token_string == '@'
+            at_statement_start = False
+    except (SyntaxError, tokenize.TokenError):
+        return [source]
+
+    disabled_ranges = autopep8.get_disabled_ranges(source)
+    definitions = [number for number in definitions
+                   if not any(first <= number <= last
+                              for (first, last) in disabled_ranges)]
+
+    boundaries = []
+    target_length = len(lines) / parts
+    previous = 1
+    for number in definitions:
+        if number <= last_import or lines[number - 2] != '\n':
+            continue
+
+        index = number - 2
+        while index >= 0 and not lines[index].strip():
+            index -= 1
+        if (
+            index < 0 or
+            lines[index].lstrip().startswith('#') or
+            lines[index].rstrip('\n').endswith('\\')
+        ):
+            continue
+
+        if number - previous >= target_length:
+            boundaries.append(number)
+            previous = number
+
+    edges = [1] + boundaries + [len(lines) + 1]
+    return [''.join(lines[first - 1:last - 1])
+            for (first, last) in zip(edges, edges[1:])]
+
+
+def join_source(parts):
+    """Return formatted pieces of split_source() joined into one source."""
+    return '\n\n\n'.join([part.rstrip('\n') for part in parts[:-1]] +
+                         [parts[-1]])
+
+
+class ResultCache(object):
+
+    """On-disk cache of formatting results.
+
+    Entries are keyed by a digest of the source bytes and the pipeline
+    fingerprint. Each entry records either that the source is already
+    formatted or the formatted source. Entries are written atomically, so
+    several processes can share a cache directory.
+    """
+
+    UNCHANGED = b'='
+    CHANGED = b'+'
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(data, pipeline, line_ranges=None, max_passes=1):
+        """Return cache key for source bytes formatted by pipeline.
+
+        line_ranges are the ranges of lines to format, if not all of them.
+        max_passes is the number of times the pipeline may run.
+        """
+        import hashlib
+        digest = hashlib.sha256(pipeline.fingerprint.encode('ascii'))
+        if line_ranges is not None:
+            digest.update(repr(_normalize_line_ranges(line_ranges)).encode(
+                'ascii'))
+            digest.update(b'\0')
+        if max_passes != 1:
+            digest.update('passes={}\0'.format(max_passes).encode('ascii'))
+        digest.update(data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def blob_key(object_id, pipeline, max_passes=1):
+        """Return cache key for the git blob object_id formatted by pipeline.
+
+        Only the result that the blob is already formatted is stored under
+        such a key.
+        """
+        import hashlib
+        # Keys of source bytes start with the hexadecimal fingerprint.
+        digest = hashlib.sha256(b'git-blob\0')
+        digest.update(pipeline.fingerprint.encode('ascii'))
+        digest.update('\0passes={}\0'.format(max_passes).encode('ascii'))
+        digest.update(object_id.encode('ascii'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key, source):
+        """Return cached formatted source or None on a miss."""
+        entry = self.entry(key)
+        if entry is None:
+            return None
+        return self.decode_entry(entry, source)
+
+    def entry(self, key):
+        """Return the stored entry or None on a miss.
+
+        An entry of formatted source is just UNCHANGED, so callers can tell
+        without decoding anything.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                entry = cache_file.read()
+        except OSError:
+            return None
+
+        try:
+            # Record the use for least recently used eviction.
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entry
+
+    @classmethod
+    def decode_entry(cls, entry, source):
+        """Return formatted source recorded by entry or None if invalid."""
+        if entry[:1] == cls.UNCHANGED:
+            return source
+        if entry[:1] == cls.CHANGED:
+            return entry[1:].decode('utf-8')
+        return None
+
+    def put(self, key, source, formatted_source):
+        """Store the result of formatting source."""
+        if source == formatted_source:
+            entry = self.UNCHANGED
+        else:
+            entry = self.CHANGED + formatted_source.encode('utf-8')
+
+        import tempfile
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                             prefix='.', delete=False) as f:
+                f.write(entry)
+            os.replace(f.name, path)
+        except OSError:
+            pass
+
+    def prune_is_due(self, interval=PRUNE_INTERVAL):
+        """Return True if the cache was last pruned interval seconds ago.
+
+        The time of the next pruning is recorded at once, so that processes
+        running at the same time do not all prune the cache.
+        """
+        stamp_path = os.path.join(self.directory, PRUNE_STAMP_FILENAME)
+        try:
+            if time.time() - os.stat(stamp_path).st_mtime < interval:
+                return False
+        except OSError:
+            pass
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(stamp_path, 'wb'):
+                pass
+        except OSError:
+            pass
+        return True
+
+    def prune(self):
+        """Evict least recently used entries until under max_size.
+
+        The other files in the directory, such as stat indexes, count
+        against max_size too and are evicted along with the entries. A stat
+        index and its journal are evicted together.
+        """
+        # Paths of each unit of eviction by name.
+        units = {}
+        try:
+            shards = list(os.scandir(self.directory))
+        except OSError:
+            return
+
+        for shard in shards:
+            try:
+                if not shard.is_dir():
+                    if shard.name != PRUNE_STAMP_FILENAME:
+                        name = shard.name
+                        if name.startswith(STAT_INDEX_PREFIX):
+                            name = name.split('.json')[0]
+                        units.setdefault(name, []).append(
+                            (shard.path, shard.stat()))
+                    continue
+                for entry in os.scandir(shard.path):
+                    units[entry.path] = [(entry.path, entry.stat())]
+            except OSError:
+                continue
+
+        entries = []
+        total_size = 0
+        for files in units.values():
+            size = sum(_allocated_size(info) for (_, info) in files)
+            entries.append((max(info.st_mtime for (_, info) in files), size,
+                            [path for (path, _) in files]))
+            total_size += size
+
+        entries.sort()
+        for (_, size, paths) in entries:
+            if total_size <= self.max_size:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_size -= size
+
+
+def _allocated_size(info):
+    """Return bytes of disk space taken by the file with stat result info.
+
+    Small files take a whole block, which their size does not show.
+    """
+    blocks = getattr(info, 'st_blocks', None)
+    if blocks is None:
+        return info.st_size
+    return blocks * 512
+
+
+class StatIndex(object):
+
+    """On-disk index of files known to be formatted.
+
+    A file is known to be formatted if its size, modification and status
+    change times and inode are those recorded. The status change time
+    catches modification times that were set back. Each index belongs to
+    one pipeline fingerprint and one repository, so changing options or
+    formatter versions starts another one, and a run only loads the records
+    of the repositories it formats. Records are appended to a journal, one line each,
+    which several processes can do at once. compact() folds the journal
+    into a snapshot that is replaced atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.log'
+        self._records = None
+
+    @staticmethod
+    def filename(pipeline, max_passes=1, root=''):
+        """Return name of the index of files formatted by pipeline.
+
+        root is the directory of the repository that the files are in.
+        """
+        import hashlib
+        digest = hashlib.sha256(pipeline.fingerprint.encode('ascii'))
+        digest.update('passes={}'.format(max_passes).encode('ascii'))
+        digest.update(root.encode('utf-8', 'surrogateescape'))
+        return STAT_INDEX_PREFIX + digest.hexdigest()[:32] + '.json'
+
+    @staticmethod
+    def _record(info):
+        return [info.st_size, info.st_mtime_ns, info.st_ctime_ns,
+                info.st_ino]
+
+    def knows(self, path, info):
+        """Return True if absolute path with stat result info is formatted."""
+        if self._records is None:
+            self._records = self._load()
+        return self._records.get(path) == self._record(info)
+
+    def add(self, path, info):
+        """Record that absolute path with stat result info is formatted."""
+        if info.st_mtime_ns <= time.time_ns() - RACY_INTERVAL_NS:
+            self._append(path, self._record(info))
+
+    def knows_directory(self, path, digest):
+        """Return True if the files of absolute directory path are formatted.
+
+        digest is the summary of the Python files in the directory, as
+        returned by DirectorySummaries.digest().
+        """
+        if self._records is None:
+            self._records = self._load()
+        return self._records.get(os.path.join(path, '')) == [digest]
+
+    def add_directory(self, path, digest):
+        """Record that the files of absolute directory path are formatted."""
+        # No file has a path ending in a separator.
+        self._append(os.path.join(path, ''), [digest])
+
+    def reload(self):
+        """Read the records again, including those of other processes."""
+        self._records = None
+
+    def _append(self, key, record):
+        import json
+
+        if self._records is None:
+            self._records = self._load()
+        if self._records.get(key) == record:
+            return
+        self._records[key] = record
+
+        # A single write in append mode does not interleave with the writes
+        # of other processes.
+        line = json.dumps([key] + record) + '\n'
+        try:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            journal = os.open(self.journal_path,
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(journal, line.encode('ascii'))
+            finally:
+                os.close(journal)
+        except OSError:
+            pass
+
+    def _load(self, journal_path=None):
+        """Return records of the snapshot updated by those of the journal."""
+        import json
+
+        try:
+            with open(self.path) as input_file:
+                records = json.load(input_file)
+            # Record the use for least recently used eviction.
+            os.utime(self.path)
+        except (OSError, ValueError):
+            records = {}
+        if not isinstance(records, dict):
+            records = {}
+
+        try:
+            with open(journal_path or self.journal_path) as input_file:
+                for line in input_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Being written by another process.
+                        continue
+                    records[record[0]] = record[1:]
+        except OSError:
+            pass
+        return records
+
+    def compact(self, drop_missing=False):
+        """Fold the journal into the snapshot.
+
+        If drop_missing is true, records of files and directories that no
+        longer exist are dropped as well.
+        """
+        import json
+        import tempfile
+
+        # Records appended after the move are lost, which only means that
+        # their files are read again.
+        moved_path = '{}.{}'.format(self.journal_path, os.getpid())
+        try:
+            os.replace(self.journal_path, moved_path)
+        except OSError:
+            if not drop_missing:
+                return
+            moved_path = None
+
+        records = self._load(moved_path)
+        if drop_missing:
+            records = {path: record for (path, record) in records.items()
+                       if os.path.lexists(path)}
+        try:
+            with tempfile.NamedTemporaryFile('w',
+                                             dir=os.path.dirname(self.path),
+                                             prefix='.', delete=False) as f:
+                json.dump(records, f)
+            os.replace(f.name, self.path)
+            if moved_path is not None:
+                os.remove(moved_path)
+        except OSError:
+            pass
+        self._records = None
+
+
+class DirectorySummaries(object):
+
+    """Summaries of directories whose Python files are all formatted.
+
+    A summary digests the names and stat results of the Python files of a
+    directory. It is recorded in the stat index of the directory once the
+    index knows each of those files to be formatted. Recursive discovery
+    then leaves out all files of a directory whose summary is unchanged,
+    which saves their pipeline and index lookups but not their stat calls:
+    each file is still examined once to compute the summary. Neither the
+    stat calls nor the listing of subdirectories can be skipped based on
+    the times of a directory, since files can be modified in place without
+    changing those.
+    """
+
+    def __init__(self, index_for_directory):
+        self._index_for_directory = index_for_directory
+        self._pending = []
+
+    @staticmethod
+    def digest(entries):
+        """Return summary of the files of os.DirEntry entries.
+
+        This examines each file, which takes a stat call per file on most
+        platforms. Raise OSError if a file cannot be examined.
+        """
+        import hashlib
+        digest = hashlib.sha256()
+        for entry in entries:
+            digest.update('{}\0{}\0'.format(
+                entry.name, StatIndex._record(entry.stat())).encode(
+                    'utf-8', 'surrogateescape'))
+        return digest.hexdigest()
+
+    def select(self, directory, entries):
+        """Return those of the file entries of directory to format.
+
+        This may be called from several threads at once.
+        """
+        index = self._index_for_directory(directory)
+        if index is None or not entries:
+            return entries
+        try:
+            digest = self.digest(entries)
+        except OSError:
+            return entries
+
+        path = os.path.abspath(directory)
+        if index.knows_directory(path, digest):
+            return []
+        # Appending to a list is atomic.
+        self._pending.append((index, path, digest, entries))
+        return entries
+
+    def update(self):
+        """Record summaries of the selected directories now formatted."""
+        reloaded = set()
+        for (index, path, digest, entries) in self._pending:
+            if id(index) not in reloaded:
+                index.reload()
+                reloaded.add(id(index))
+            if all(index.knows(os.path.join(path, entry.name), entry.stat())
+                   for entry in entries):
+                index.add_directory(path, digest)
+        self._pending = []
+
+
+@functools.lru_cache(maxsize=None)
+def _stat_index(directory, name):
+    return StatIndex(os.path.join(directory, name))
+
+
+def _file_stat_index(path, pipeline, args):
+    """Return the stat index for absolute path formatted by pipeline.
+
+    Files outside of repositories share the index of the working directory.
+    """
+    root = _repository_root(os.path.dirname(path)) or os.getcwd()
+    return _stat_index(args.cache_dir,
+                       StatIndex.filename(pipeline, args.max_passes, root))
+
+
+@functools.lru_cache(maxsize=None)
+def _repository_root(directory):
+    """Return root of the repository that absolute directory is in.
+
+    Return '' if it is not in a repository.
+    """
+    if os.path.lexists(os.path.join(directory, '.git')):
+        return directory
+    parent = os.path.dirname(directory)
+    if parent == directory:
+        return ''
+    return _repository_root(parent)
 
-    return formatted_source
+
+def compact_stat_indexes(directory, drop_missing=False,
+                         max_journal_size=STAT_JOURNAL_MAX_SIZE):
+    """Fold the journals of the stat indexes in directory into them.
+
+    Only journals larger than max_journal_size bytes are folded in. If
+    drop_missing is true, every index is compacted and records of files and
+    directories that no longer exist are dropped.
+    """
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    names = set()
+    for entry in entries:
+        if not entry.name.startswith(STAT_INDEX_PREFIX):
+            continue
+        if entry.name.endswith('.json.log'):
+            try:
+                if (
+                    drop_missing or
+                    entry.stat().st_size > max_journal_size
+                ):
+                    names.add(entry.name[:-len('.log')])
+            except OSError:
+                pass
+        elif drop_missing and entry.name.endswith('.json'):
+            names.add(entry.name)
+    for name in sorted(names):
+        _stat_index(directory, name).compact(drop_missing)
+
+
+def default_cache_directory():
+    """Return default directory of the result cache."""
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'),
+        'pyformat')
+
+
+@functools.lru_cache(maxsize=None)
+def _result_cache(directory):
+    return ResultCache(directory)
 
 
 def detect_io_encoding(input_file: io.BytesIO, limit_byte_check=-1):
     """Return file encoding."""
+    return decode_source(input_file.read(limit_byte_check))[1]
+
+
+def decode_source(data: bytes) -> Tuple[str, str]:
+    """Return source decoded from bytes and its encoding.
+
+    Source that does not decode with the encoding given by its byte order
+    mark or coding cookie, UTF-8 by default, is read as latin-1.
+    """
     try:
-        from lib2to3.pgen2 import tokenize as lib2to3_tokenize
-        encoding: str = lib2to3_tokenize.detect_encoding(input_file.readline)[
-            0]
+        encoding = _detect_encoding(data)
+        return data.decode(encoding), encoding
+    except (LookupError, UnicodeDecodeError):
+        return data.decode('latin-1'), 'latin-1'
 
-        input_file.read(limit_byte_check).decode(encoding)
 
-        return encoding
-    except (LookupError, SyntaxError, UnicodeDecodeError):
-        return 'latin-1'
+def _detect_encoding(data: bytes) -> str:
+    """Return encoding given by byte order mark or coding cookie of source.
+
+    Raise LookupError if the encoding is unknown or contradicts the byte
+    order mark.
+    """
+    default = 'utf-8'
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+        default = 'utf-8-sig'
+
+    second_newline = data.find(b'\n', data.find(b'\n') + 1)
+    head = data if second_newline < 0 else data[:second_newline]
+    if b'coding' not in head:
+        # Most files have no cookie, so skip matching lines.
+        return default
+
+    for line in head.split(b'\n'):
+        match = CODING_COOKIE_REGEX.match(line) if line.isascii() else None
+        if match:
+            encoding = _normal_encoding_name(match.group(1).decode('ascii'))
+            if default == 'utf-8-sig':
+                if codecs.lookup(encoding).name != 'utf-8':
+                    raise LookupError('encoding problem: utf-8')
+                encoding += '-sig'
+            codecs.lookup(encoding)
+            return encoding
+        if not BLANK_LINE_REGEX.match(line):
+            break
+    return default
+
+
+def _normal_encoding_name(name: str) -> str:
+    """Return name of encoding as tokenize normalizes it."""
+    normal_name = name[:12].lower().replace('_', '-')
+    if normal_name == 'utf-8' or normal_name.startswith('utf-8-'):
+        return 'utf-8'
+    if normal_name in ('latin-1', 'iso-8859-1', 'iso-latin-1') or (
+            normal_name.startswith(('latin-1-', 'iso-8859-1-',
+                                    'iso-latin-1-'))):
+        return 'iso-8859-1'
+    return name
 
 
 def read_file(filename: str) -> Tuple[str, str]:
     """Read file from filesystem or from stdin when `-` is given."""
+    return _read_source(filename)[1:]
 
+
+def _read_source(filename: str) -> Tuple[bytes, str, str]:
+    """Return raw bytes, decoded source and encoding of file."""
+    data = _read_data(filename)
+    return (data,) + decode_source(data)
+
+
+def _read_data(filename: str) -> bytes:
+    """Return raw bytes of file or of stdin when `-` is given."""
     if is_stdin(filename):
-        data = sys.stdin.buffer.read()
-    else:
-        with open(filename, 'rb') as fp:
-            data = fp.read()
-    input_file = io.BytesIO(data)
-    encoding = detect_io_encoding(input_file)
-    return data.decode(encoding), encoding
+        return sys.stdin.buffer.read()
+    with open(filename, 'rb') as fp:
+        return fp.read()
 
 
 def is_stdin(filename: str):
     return filename == '-'
 
 
-def format_file(filename, args, standard_out):
+def format_file(filename, args, standard_out, profile=None, stats=None):
     """Run format_code() on a file.
 
-    Return True if the new formatting differs from the original.
+    Return True if the new formatting differs from the original. If stats
+    is a dictionary, the number of passes made and whether they converged
+    are stored in it.
+
+    Files that the stat index knows to be formatted are not read, and those
+    that the result cache knows to be formatted are not decoded. Formatted
+    source is encoded once, for both the cache and the file.
     """
-    source, encoding = read_file(filename)
+    echo = args.in_place and is_stdin(filename)
+
+    index = path = info = None
+    if args.cache:
+        pipeline = get_pipeline(**_format_options(args, filename))
+        line_ranges = _line_ranges(args, filename)
+        if line_ranges is None and not is_stdin(filename):
+            # Changes made while the file is read show in a later stat.
+            path = os.path.abspath(filename)
+            index = _file_stat_index(path, pipeline, args)
+            info = os.stat(filename)
+            if index.knows(path, info):
+                if args.blob_ids is not None:
+                    _record_formatted_blob(
+                        args.blob_ids.get(os.path.realpath(filename)),
+                        pipeline, args)
+                return False
+
+    data = _read_data(filename)
+    if not data:
+        return False
+
+    cache_key = cache_entry = None
+    if args.cache:
+        cache_key = ResultCache.key(data, pipeline, line_ranges,
+                                    args.max_passes)
+        cache_entry = _result_cache(args.cache_dir).entry(cache_key)
+        if cache_entry == ResultCache.UNCHANGED and not echo:
+            _record_formatted(data, pipeline, args, index, path, info)
+            return False
+
+    (source, encoding) = decode_source(data)
 
     if not source:
         return False
 
-    formatted_source = format_code(
-        source,
+    (formatted_source, formatted_data) = _format_source(
+        source, filename, args, profile=profile, encoding=encoding,
+        stats=stats, cache_key=cache_key, cache_entry=cache_entry)
+
+    # Strings of different lengths compare unequal without looking at their
+    # characters.
+    changed = formatted_source != source
+    if not changed and args.cache:
+        _record_formatted(data, pipeline, args, index, path, info)
+
+    if args.check:
+        if changed:
+            standard_out.write(filename + '\n')
+        return changed
+
+    # Always write to stdout (even when no changes were made) when working with
+    # in-place stdin. This is what most tools (editors) expect.
+    if echo:
+        standard_out.write(formatted_source)
+        return True
+
+    if not changed:
+        return False
+
+    if args.in_place:
+        if formatted_data is None:
+            formatted_data = formatted_source.encode(encoding)
+        with open(filename, 'wb') as output_file:
+            output_file.write(formatted_data)
+    else:
+        import autopep8
+        standard_out.write(autopep8.get_diff_text(
+            io.StringIO(source).readlines(),
+            io.StringIO(formatted_source).readlines(),
+            filename))
+
+    return True
+
+
+def _record_formatted(data, pipeline, args, index=None, path=None,
+                      info=None):
+    """Record that data is formatted by pipeline.
+
+    The path and stat result info of its file go to index, if given. With
+    --git-index, the git blob ID of data goes to the result cache.
+    """
+    if index is not None:
+        index.add(path, info)
+    if args.blob_ids is not None:
+        _record_formatted_blob(git_blob_id(data), pipeline, args)
+
+
+def _record_formatted_blob(object_id, pipeline, args):
+    """Record that the git blob object_id is formatted by pipeline."""
+    if object_id is not None:
+        # Equal sources are stored as an unchanged entry.
+        _result_cache(args.cache_dir).put(
+            ResultCache.blob_key(object_id, pipeline, args.max_passes),
+            '', '')
+
+
+def _format_source(source, filename, args, profile=None,
+                   encoding=None, stats=None, cache_key=None,
+                   cache_entry=None):
+    """Return formatted source and its bytes in encoding if encoded.
+
+    cache_key and cache_entry are the result cache key of the bytes of
+    source and the entry stored under it, if the cache is used. On a miss,
+    the daemon is consulted before formatting in-process.
+
+    When the formatters converge, the result is also cached as unchanged
+    under its own bytes in encoding, so that formatting it again is a
+    cache hit.
+    """
+    if cache_entry is not None:
+        formatted_source = ResultCache.decode_entry(cache_entry, source)
+        if formatted_source is not None:
+            return (formatted_source, None)
+
+    options = _format_options(args, filename)
+    line_ranges = _line_ranges(args, filename)
+
+    if args.use_daemon and profile is None:
+        formatted_source = format_code_with_daemon(source, args.socket,
+                                                   line_ranges=line_ranges,
+                                                   max_passes=args.max_passes,
+                                                   **options)
+        if formatted_source is not None:
+            return (formatted_source, None)
+
+    pipeline = get_pipeline(**options)
+
+    def run_pass(source):
+        if _should_split(args, source.count('\n')) and line_ranges is None:
+            return format_code_in_parallel(source, args.jobs,
+                                           profile=profile, **options)
+        return pipeline(source, profile=profile, line_ranges=line_ranges)
+
+    (formatted_source, passes, converged) = iterate_to_fixpoint(
+        run_pass, source, args.max_passes)
+    if stats is not None:
+        stats.update(passes=passes, converged=converged)
+
+    formatted_data = None
+    if cache_key is not None:
+        cache = _result_cache(args.cache_dir)
+        cache.put(cache_key, source, formatted_source)
+        if (
+            converged and args.max_passes > 1 and encoding and
+            formatted_source != source
+        ):
+            try:
+                formatted_data = formatted_source.encode(encoding)
+            except UnicodeEncodeError:
+                pass
+            else:
+                cache.put(cache.key(formatted_data, pipeline, line_ranges,
+                                    args.max_passes),
+                          formatted_source, formatted_source)
+    return (formatted_source, formatted_data)
+
+
+def _line_ranges(args, filename):
+    """Return ranges of lines of filename to format or None for all."""
+    if args.line_ranges is None:
+        return None
+    return args.line_ranges.get(os.path.realpath(filename))
+
+
+def _format_options(args, filename):
+    """Return options of format_code() for formatting filename."""
+    return dict(
         aggressive=args.aggressive,
         apply_config=args.config,
         filename=filename,
@@ -153,40 +1688,218 @@ def format_file(filename, args, standard_out):
         sort_imports=args.sort_imports,
         add_trailing_comma=args.add_trailing_comma)
 
-    # Always write to stdout (even when no changes were made) when working with
-    # in-place stdin. This is what most tools (editors) expect.
-    if args.in_place and is_stdin(filename):
-        standard_out.write(formatted_source)
-        return True
 
-    if source != formatted_source:
-        if args.in_place:
-            with autopep8.open_with_encoding(filename, mode='w',
-                                             encoding=encoding) as output_file:
-                output_file.write(formatted_source)
+def _should_split(args, line_count):
+    """Return True if a file of line_count lines is split into parts."""
+    return bool(args.split_lines and args.jobs > 1 and
+                line_count >= args.split_lines)
+
+
+def _line_count(filename):
+    """Return number of lines of file or zero if it cannot be read."""
+    try:
+        with open(filename, 'rb') as input_file:
+            return input_file.read().count(b'\n')
+    except (OSError, ValueError):
+        return 0
+
+
+def default_socket_path():
+    """Return default path of the daemon socket."""
+    import tempfile
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    name = 'pyformat.sock'
+    if hasattr(os, 'getuid'):
+        name = 'pyformat-{}.sock'.format(os.getuid())
+    return os.path.join(directory, name)
+
+
+def _is_own_socket(path):
+    """Return True if path is a socket created by the current user.
+
+    The default socket may be in the shared temporary directory, where
+    another user could listen in its place and answer with any code.
+    """
+    import stat
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(info.st_mode):
+        return False
+    return not hasattr(os, 'getuid') or info.st_uid == os.getuid()
+
+
+def format_code_with_daemon(source, socket_path, **options):
+    """Return source formatted by the daemon listening on socket_path.
+
+    Return None if no daemon is reachable, the socket belongs to another
+    user or the daemon fails, in which case callers should format
+    in-process.
+    """
+    import json
+    import socket
+
+    if not hasattr(socket, 'AF_UNIX') or not _is_own_socket(socket_path):
+        return None
+
+    if options.get('filename'):
+        options['filename'] = os.path.abspath(options['filename'])
+
+    request = {'source': source, 'options': options, 'cwd': os.getcwd()}
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with client.makefile('rb') as reader:
+                response = json.loads(reader.readline().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+    return response.get('formatted')
+
+
+def _handle_daemon_request(request):
+    """Return the response to a daemon request.
+
+    A request contains either source text or a filename to read, plus
+    format_code() options and optionally the client's working directory.
+    This runs in daemon worker processes, which handle one request at a time.
+    """
+    try:
+        _forget_configuration()
+        if request.get('cwd'):
+            os.chdir(request['cwd'])
+
+        options = {key: value
+                   for key, value in request.get('options', {}).items()
+                   if key in DAEMON_OPTIONS}
+
+        if 'source' in request:
+            source = request['source']
+            response = {}
         else:
-            diff = autopep8.get_diff_text(
-                io.StringIO(source).readlines(),
-                io.StringIO(formatted_source).readlines(),
-                filename)
-            standard_out.write(''.join(diff))
+            (_, source, encoding) = _read_source(request['filename'])
+            options.setdefault('filename', request['filename'])
+            response = {'source': source, 'encoding': encoding}
 
-        return True
+        response['formatted'] = format_code(source, **options)
+    except Exception as exception:
+        response = {'error': '{}: {}'.format(type(exception).__name__,
+                                             exception)}
 
-    return False
+    return response
+
+
+def _warm_up_daemon_worker():
+    """Build the default pipeline ahead of the first request."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_pipeline()
+
+
+def make_daemon_server(socket_path, jobs=1):
+    """Return a server that formats requests received on socket_path.
+
+    Requests and responses are JSON objects, one per line. Requests are
+    formatted by a pool of jobs worker processes that keep their pipelines
+    between requests.
+    """
+    import json
+    import multiprocessing
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    response = {'error': 'invalid request'}
+                else:
+                    response = self.server.pool.apply(
+                        _handle_daemon_request, (request,))
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+        daemon_threads = True
+
+        def server_close(self):
+            socketserver.UnixStreamServer.server_close(self)
+            self.pool.terminate()
+            self.pool.join()
+            try:
+                os.remove(self.server_address)
+            except OSError:
+                pass
+
+    pool = multiprocessing.Pool(jobs, initializer=_warm_up_daemon_worker)
+    # Only the owner may connect, since requests can read and write any file
+    # the daemon can. The umask applies when the socket is bound, so there is
+    # no window in which others could connect.
+    umask = os.umask(0o177)
+    try:
+        server = Server(socket_path, RequestHandler)
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        os.umask(umask)
+    server.pool = pool
+    return server
+
+
+def serve_daemon(socket_path, jobs, standard_error):
+    """Serve formatting requests until interrupted. Return exit status."""
+    import stat
+
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            print('{} exists and is not a socket'.format(socket_path),
+                  file=standard_error)
+            return 1
+        if not _is_own_socket(socket_path):
+            print('{} belongs to another user'.format(socket_path),
+                  file=standard_error)
+            return 1
+        if format_code_with_daemon('', socket_path) is not None:
+            print('daemon already running on {}'.format(socket_path),
+                  file=standard_error)
+            return 1
+        # Left behind by a daemon that did not shut down cleanly.
+        os.remove(socket_path)
+
+    server = make_daemon_server(socket_path, jobs)
+
+    def terminate(signal_number, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    print('listening on {}'.format(socket_path), file=standard_error)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+    return 0
 
 
 def _format_file(parameters):
     """Helper function for optionally running format_file() in parallel."""
-    (filename, args, _, standard_error) = parameters
+    (filename, args, standard_out, standard_error, profile) = parameters
 
     standard_error = standard_error or sys.stderr
 
     if args.verbose:
         print('{0}: '.format(filename), end='', file=standard_error)
 
+    stats = {}
     try:
-        changed = format_file(*parameters[:-1])
+        changed = format_file(filename, args, standard_out, profile=profile,
+                              stats=stats)
     except IOError as exception:
         print('{}'.format(exception), file=standard_error)
         return (False, True)
@@ -194,33 +1907,921 @@ def _format_file(parameters):
         return (False, True)  # pragma: no cover
 
     if args.verbose:
-        print('changed' if changed else 'unchanged', file=standard_error)
+        message = 'changed' if changed else 'unchanged'
+        if args.max_passes > 1 and stats:
+            message += (' ({passes} passes)' if stats['converged'] else
+                        ' (not converged after {passes} passes)').format(
+                            **stats)
+        print(message, file=standard_error)
 
     return (changed, False)
 
 
+def _format_file_captured(filename, args, profile=None):
+    """Return changed, error and output of running _format_file().
+
+    Output written to standard output and standard error is returned as text
+    since multiprocessing cannot serialize io.
+    """
+    output_file = io.StringIO()
+    error_file = io.StringIO()
+    (changed, error) = _format_file((filename, args, output_file, error_file,
+                                     profile))
+    return (changed, error, output_file.getvalue(), error_file.getvalue())
+
+
+# Options of the run, set in each pool worker by _initialize_worker().
+_worker_args = None
+
+
+def _initialize_worker(args):
+    """Store options in a pool worker so that tasks need not carry them."""
+    global _worker_args
+    # The parent process handles interrupts by terminating the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_args = args
+
+
+def _format_chunk(chunk, args=None):
+    """Return results of formatting each (index, filename) in chunk.
+
+    Each result is (index, changed, error, output, error_output, duration).
+    The results are returned with the stage profile of the chunk, which is
+    None unless profiling. args defaults to the options of the pool worker.
+    """
+    args = args or _worker_args
+    profile = {} if _is_profiling(args) else None
+    results = []
+    for (index, name) in chunk:
+        start_time = time.perf_counter()
+        result = _format_file_captured(name, args, profile=profile)
+        results.append((index,) + result +
+                       (time.perf_counter() - start_time,))
+    return (results, profile)
+
+
+def _is_profiling(args):
+    return args.profile or args.profile_json is not None
+
+
+def _chunks(files, sizes):
+    """Yield lists of (index, filename) to be formatted by one task.
+
+    Small files are grouped to amortize the cost of a task, while large
+    files get a task of their own so that work stays evenly spread.
+    """
+    chunk = []
+    chunk_size = 0
+    for (index, name) in files:
+        chunk.append((index, name))
+        chunk_size += sizes[index]
+
+        if chunk_size >= CHUNK_BYTES or len(chunk) >= MAX_CHUNK_LENGTH:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+
+    if chunk:
+        yield chunk
+
+
+def _file_sizes(filenames):
+    """Return sizes of files in bytes, zero for those that cannot be read."""
+    sizes = []
+    for name in filenames:
+        try:
+            sizes.append(os.stat(name).st_size)
+        except (OSError, ValueError):
+            sizes.append(0)
+    return sizes
+
+
+def _longest_first(filenames, sizes, durations):
+    """Return indices of filenames ordered by decreasing expected duration.
+
+    durations maps absolute paths to durations recorded by earlier runs.
+    Files without a recorded duration are estimated from their size, scaled
+    by the time per byte of the files with one.
+    """
+    paths = [os.path.abspath(name) for name in filenames]
+
+    known = [(durations[path], size) for (path, size) in zip(paths, sizes)
+             if path in durations]
+    known_size = sum(size for (_, size) in known)
+    seconds_per_byte = (sum(duration for (duration, _) in known) /
+                        known_size if known_size else 1.0)
+
+    estimates = [durations.get(path, size * seconds_per_byte)
+                 for (path, size) in zip(paths, sizes)]
+    return sorted(range(len(filenames)), key=lambda index: -estimates[index])
+
+
+def _load_durations(path):
+    """Return per-file durations recorded by earlier runs."""
+    import json
+    try:
+        with open(path) as input_file:
+            durations = json.load(input_file)
+    except (OSError, ValueError):
+        return {}
+    return durations if isinstance(durations, dict) else {}
+
+
+def _save_durations(path, durations):
+    """Merge durations into the history file at path."""
+    import json
+    import tempfile
+
+    history = _load_durations(path)
+    history.update(durations)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                         prefix='.', delete=False) as f:
+            json.dump(history, f)
+        os.replace(f.name, path)
+    except OSError:
+        pass
+
+
+def _format_files_in_parallel(filenames, args, standard_out, standard_error,
+                              profile=None):
+    """Yield (changed, error) of formatting files in a process pool.
+
+    Files expected to take longest are submitted first, so that a large
+    file does not end up as the tail of the run. Files with at least
+    --split-lines lines are formatted before the others, each by all jobs.
+    Results are yielded as tasks complete. Output is written in the order
+    of filenames, while verbose and error messages are written as soon as
+    they are available. Only a bounded number of tasks is in flight. If too
+    much output is held back waiting for an earlier file, files are
+    submitted in input order until it can be written. Stage profiles of the
+    tasks are merged into profile.
+    """
+    import multiprocessing
+    import queue
+
+    standard_error = standard_error or sys.stderr
+
+    filenames = list(filenames)
+    sizes = _file_sizes(filenames)
+    history_path = (os.path.join(args.cache_dir, DURATIONS_FILENAME)
+                    if args.cache else None)
+    durations = _load_durations(history_path) if history_path else {}
+    order = _longest_first(filenames, sizes, durations)
+
+    completed = queue.Queue()
+    submitted = [False] * len(filenames)
+    held_output = {}
+    measured = {}
+    state = {'flushed': 0, 'held_size': 0, 'in_flight': 0}
+    start_time = time.perf_counter()
+
+    def handle(task_result):
+        if isinstance(task_result, BaseException):
+            raise task_result
+
+        (results, task_profile) = task_result
+        if task_profile:
+            merge_profiles(profile, task_profile)
+
+        for (index, changed, error, output, error_output,
+             duration) in results:
+            standard_error.write(error_output)
+            held_output[index] = output
+            state['held_size'] += len(output)
+            measured[os.path.abspath(filenames[index])] = duration
+            yield (changed, error)
+
+        while state['flushed'] in held_output:
+            output = held_output.pop(state['flushed'])
+            state['held_size'] -= len(output)
+            standard_out.write(output)
+            state['flushed'] += 1
+
+    def files_to_submit():
+        remaining = iter(order)
+        lowest = 0
+        while True:
+            if state['held_size'] > MAX_HELD_OUTPUT:
+                while lowest < len(filenames) and submitted[lowest]:
+                    lowest += 1
+                index = lowest if lowest < len(filenames) else None
+            else:
+                index = next((index for index in remaining
+                              if not submitted[index]), None)
+            if index is None:
+                return
+            submitted[index] = True
+            yield (index, filenames[index])
+
+    # Workers cannot read our standard input. Files that are split into
+    # parts are formatted by a pool of their own, one at a time. A file has
+    # at least as many bytes as lines, so most files are not read here.
+    for (index, name) in enumerate(filenames):
+        if is_stdin(name) or (
+            _should_split(args, sizes[index]) and
+            _should_split(args, _line_count(name))
+        ):
+            submitted[index] = True
+            yield from handle(_format_chunk([(index, name)], args))
+
+    pool = multiprocessing.Pool(args.jobs,
+                                initializer=_initialize_worker,
+                                initargs=(args,))
+
+    def handle_task(results):
+        state['in_flight'] -= 1
+        return handle(results)
+
+    try:
+        for chunk in _chunks(files_to_submit(), sizes):
+            while state['in_flight'] >= PENDING_TASKS_PER_JOB * args.jobs:
+                yield from handle_task(completed.get())
+
+            pool.apply_async(_format_chunk, (chunk,),
+                             callback=completed.put,
+                             error_callback=completed.put)
+            state['in_flight'] += 1
+
+        while state['in_flight']:
+            yield from handle_task(completed.get())
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    wall_time = time.perf_counter() - start_time
+    if args.verbose and wall_time > 0:
+        work_time = sum(measured.values())
+        print('parallel efficiency: {:.0%} ({:.2f} s of work in {:.2f} s '
+              'on {} jobs)'.format(work_time / (args.jobs * wall_time),
+                                   work_time, wall_time, args.jobs),
+              file=standard_error)
+
+    if history_path:
+        _save_durations(history_path, measured)
+
+
 def format_multiple_files(filenames, args, standard_out, standard_error):
     """Format files and return booleans (any_changes, any_errors).
 
     Optionally format files recursively.
     """
-    filenames = autopep8.find_files(list(filenames),
-                                    args.recursive,
-                                    args.exclude_patterns)
+    summaries = None
+    if args.cache and args.recursive and args.line_ranges is None:
+        summaries = DirectorySummaries(
+            functools.partial(_directory_stat_index, args=args))
+    filenames = find_files(filenames, args.recursive, args.exclude_patterns,
+                           jobs=args.walk_jobs, gitignore=args.gitignore,
+                           summaries=summaries)
+    if args.blob_ids is not None:
+        filenames = _skip_formatted_blobs(filenames, args, standard_error)
+    profile = {} if _is_profiling(args) else None
+
     if args.jobs > 1:
-        import multiprocessing
-        pool = multiprocessing.Pool(args.jobs)
+        results = _format_files_in_parallel(filenames, args,
+                                            standard_out, standard_error,
+                                            profile=profile)
+    else:
+        results = (_format_file((name, args, standard_out, standard_error,
+                                 profile))
+                   for name in filenames)
+
+    any_changes = False
+    any_errors = False
+    for (changed, error) in results:
+        any_changes |= changed
+        any_errors |= error
+        if changed and args.fail_fast:
+            # Closing the generator cancels outstanding parallel work.
+            results.close()
+            break
+
+    if args.cache:
+        if summaries is not None:
+            summaries.update()
+        cache = _result_cache(args.cache_dir)
+        prune = cache.prune_is_due()
+        compact_stat_indexes(args.cache_dir, drop_missing=prune)
+        if prune:
+            cache.prune()
+
+    if args.profile:
+        (standard_error or sys.stderr).write(format_profile(profile))
+
+    if args.profile_json is not None:
+        import json
+        with open(args.profile_json, 'w') as output_file:
+            json.dump(profile, output_file, indent=2)
+
+    return (any_changes, any_errors)
+
+
+def _directory_stat_index(directory, args):
+    """Return the stat index of files formatted in directory."""
+    # The pipeline and index depend on the directory of the file only, so
+    # any name in it will do.
+    path = os.path.abspath(os.path.join(directory, '__init__.py'))
+    pipeline = get_pipeline(**_format_options(args, path))
+    return _file_stat_index(path, pipeline, args)
+
+
+def watch_files(filenames, args, standard_out, standard_error, stop=None,
+                debounce=WATCH_DEBOUNCE):
+    """Format files whenever they change until interrupted or stop is set.
+
+    Files are found like format_multiple_files() finds them, every
+    args.watch_interval seconds, so new files are picked up too. Changed
+    files are formatted in this process once no file has changed for
+    debounce seconds. stop is a threading.Event. Return exit status.
+    """
+    import threading
+
+    standard_error = standard_error or sys.stderr
+    stop = stop or threading.Event()
 
-        # We pass neither standard_out nor standard_error into "_format_file()"
-        # since multiprocessing cannot serialize io.
-        result = pool.map(_format_file,
-                          [(name, args, None, None) for name in filenames])
+    states = _file_states(filenames, args)
+
+    # Build the pipeline before the first change.
+    get_pipeline(**_format_options(args, next(iter(states), ''))).stages
+    pending = set()
+    last_change_time = None
+    try:
+        while not stop.wait(args.watch_interval):
+            current_states = _file_states(filenames, args)
+            changed = [name for (name, state) in current_states.items()
+                       if states.get(name) != state]
+            states = current_states
+            if changed:
+                pending.update(changed)
+                last_change_time = time.perf_counter()
+                continue
+
+            if (
+                not pending or
+                time.perf_counter() - last_change_time < debounce
+            ):
+                continue
+
+            _forget_configuration()
+            for name in sorted(pending):
+                start_time = time.perf_counter()
+                (changed, error) = _format_file(
+                    (name, args, standard_out, standard_error, None))
+                if not error:
+                    print('{}: {} in {:.1f} ms'.format(
+                        name, 'changed' if changed else 'unchanged',
+                        1000 * (time.perf_counter() - start_time)),
+                        file=standard_error)
+                # Writing the file in place is not a change to format.
+                states.update(_file_states([name], args))
+            pending.clear()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def _file_states(filenames, args):
+    """Return modification time and size of the files to format by name."""
+    states = {}
+    for name in find_files(filenames, args.recursive, args.exclude_patterns,
+                           jobs=args.walk_jobs, gitignore=args.gitignore):
+        try:
+            info = os.stat(name)
+        except OSError:
+            continue
+        states[name] = (info.st_mtime_ns, info.st_size)
+    return states
+
+
+class ExcludeMatcher(object):
+
+    """Exclude patterns compiled into a single regular expression."""
+
+    def __init__(self, patterns):
+        import fnmatch
+        self.patterns = tuple(patterns)
+        self._match = None
+        if self.patterns:
+            self._match = re.compile('|'.join(
+                fnmatch.translate(os.path.normcase(pattern))
+                for pattern in self.patterns)).match
+
+    def excludes(self, path):
+        """Return True if path matches one of the patterns."""
+        return (self._match is not None and
+                self._match(os.path.normcase(path)) is not None)
+
+    def excludes_entry(self, path):
+        """Return True if path is skipped when listing its directory.
+
+        Hidden entries are skipped, and entries whose name or path matches
+        one of the patterns.
+        """
+        name = os.path.basename(path)
+        return (name.startswith('.') or self.excludes(name) or
+                self.excludes(path))
+
+
+def find_files(filenames, recursive, exclude, jobs=1, gitignore=False,
+               summaries=None):
+    """Yield the files to format among filenames.
+
+    Names that match a pattern of exclude are left out. When recursive,
+    directories are replaced by the Python files below them, found like
+    autopep8.find_files() finds them, but as they are listed and without
+    listing excluded directories. The files of a directory come sorted by
+    name and before those of its subdirectories. Up to jobs threads list
+    directories ahead of the files being yielded.
+
+    If gitignore is true, files and directories ignored by the .gitignore
+    files of their repository and by its .git/info/exclude are excluded
+    too when recursive.
+
+    summaries is the DirectorySummaries that select the files of each
+    directory when recursive, if any.
+    """
+    matcher = ExcludeMatcher(exclude)
+    executor = None
+    try:
+        for name in filenames:
+            if recursive and os.path.isdir(name):
+                if executor is None and jobs > 1:
+                    import concurrent.futures
+                    executor = concurrent.futures.ThreadPoolExecutor(jobs)
+                ignore = GitIgnore.above(name) if gitignore else None
+                yield from _walk(name, matcher, executor, ignore, summaries)
+            elif not matcher.excludes(name):
+                yield name
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _walk(top, matcher, executor=None, ignore=None, summaries=None):
+    """Yield Python files below directory top in depth-first order.
+
+    ignore holds the GitIgnore rules that apply in top, if any. With
+    executor, the subdirectories of each listed directory are listed in it
+    ahead of time.
+    """
+    if executor is None:
+        pending = [(top, ignore)]
     else:
-        result = [_format_file((name, args, standard_out, standard_error))
-                  for name in filenames]
+        pending = [executor.submit(_scan_directory, top, matcher, ignore,
+                                   summaries)]
+    try:
+        while pending:
+            item = pending.pop()
+            (files, directories, ignore) = (
+                _scan_directory(item[0], matcher, item[1], summaries)
+                if executor is None else item.result())
+            yield from files
+            if executor is None:
+                directories = [(path, ignore) for path in directories]
+            else:
+                directories = [executor.submit(_scan_directory, path,
+                                               matcher, ignore, summaries)
+                               for path in directories]
+            pending.extend(reversed(directories))
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+
+
+def _scan_directory(path, matcher, ignore=None, summaries=None):
+    """Return the Python files and the directories to descend into in path.
+
+    Entries are sorted by name. Directories that cannot be listed are
+    empty, and symbolic links to directories are not followed. The
+    GitIgnore rules that apply in the subdirectories are returned too.
+    summaries select which of the files are returned, if given.
+    """
+    files = []
+    directories = []
+    try:
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except OSError:
+        return (files, directories, ignore)
+
+    if ignore is not None:
+        prefix = os.path.join(os.path.abspath(path), '')
+        if any(entry.name == '.gitignore' for entry in entries):
+            ignore = ignore.below(prefix)
+
+    for entry in entries:
+        if matcher.excludes_entry(entry.path):
+            continue
+        try:
+            is_directory = entry.is_dir()
+        except OSError:
+            is_directory = False
+        if (
+            ignore is not None and
+            ignore.ignores(prefix + entry.name, is_directory)
+        ):
+            continue
+        if is_directory:
+            if not entry.is_symlink():
+                directories.append(entry.path)
+        elif entry.name.endswith('.py') or _is_python_script(entry.path):
+            files.append(entry)
+
+    if summaries is not None:
+        files = summaries.select(path, files)
+    return ([entry.path for entry in files], directories, ignore)
+
+
+class GitIgnore(object):
+
+    """Ignore rules that apply in a directory of a git working tree.
+
+    Each instance holds the rules of one file, whose patterns are relative
+    to directory, and refers to the rules of the directories above.
+    """
+
+    def __init__(self, directory, lines=(), parent=None):
+        self.directory = os.path.join(directory, '')
+        self.parent = parent
+        self._matchers = _compile_gitignore(tuple(lines))
+
+    @classmethod
+    def above(cls, directory):
+        """Return the rules that apply in directory, except its own.
+
+        These are the .git/info/exclude of its repository and the
+        .gitignore files of the directories from the root of the working
+        tree down to the parent of directory. A directory outside of a
+        repository starts without rules.
+        """
+        directory = os.path.abspath(directory)
+        root = directory
+        while not os.path.exists(os.path.join(root, '.git')):
+            parent = os.path.dirname(root)
+            if parent == root:
+                return cls(directory)
+            root = parent
+
+        ignore = cls(root, _read_lines(os.path.join(root, '.git', 'info',
+                                                    'exclude')))
+        if root != directory:
+            path = root
+            for part in os.path.relpath(directory, root).split(os.sep):
+                ignore = ignore.below(path)
+                path = os.path.join(path, part)
+        return ignore
+
+    def below(self, directory):
+        """Return the rules that apply below directory.
+
+        directory is a subdirectory of that of these rules, or the same,
+        whose .gitignore is added.
+        """
+        lines = _read_lines(os.path.join(directory, '.gitignore'))
+        return GitIgnore(directory, lines, self) if lines else self
+
+    def ignores(self, path, is_directory):
+        """Return True if absolute path below directory is ignored.
+
+        The last matching pattern of the deepest file with one decides.
+        """
+        rules = self
+        while rules is not None:
+            (match, negations) = rules._matchers[is_directory]
+            if match is not None:
+                matched = match(path[len(rules.directory):].replace(os.sep,
+                                                                    '/'))
+                if matched:
+                    return not negations[matched.lastindex - 1]
+            rules = rules.parent
+        return False
+
+
+def _read_lines(filename):
+    """Return lines of file or an empty list if it cannot be read."""
+    try:
+        with open(filename, 'rb') as input_file:
+            return input_file.read().decode('utf-8', 'replace').splitlines()
+    except OSError:
+        return []
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_gitignore(lines):
+    """Return matchers of files and of directories for .gitignore lines.
+
+    Each matcher is a fullmatch function of a single regular expression
+    and the negation flag of each of its groups. The patterns are
+    alternatives in reverse, so the group that matches is that of the last
+    matching pattern. The function is None if no pattern applies.
+    """
+    rules = []
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        pattern = line.rstrip(' ')
+        if pattern.endswith('\\') and len(pattern) < len(line):
+            pattern += ' '
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            continue
+        anchored = '/' in pattern
+        regex = _translate_gitignore(pattern.lstrip('/'))
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        rules.append((regex, negated, directory_only))
+
+    def combine(selected):
+        if not selected:
+            return (None, ())
+        selected.reverse()
+        return (re.compile('|'.join('({})'.format(regex)
+                                    for (regex, _, _) in selected)).fullmatch,
+                tuple(negated for (_, negated, _) in selected))
+
+    return (combine([rule for rule in rules if not rule[2]]),
+            combine(list(rules)))
+
+
+def _translate_gitignore(pattern):
+    """Return regular expression of a .gitignore pattern.
+
+    The expression matches paths relative to the directory of the
+    .gitignore file, with / as separator, and has no capturing groups.
+    """
+    parts = []
+    index = 0
+    while index < len(pattern):
+        at_start = index == 0 or pattern[index - 1] == '/'
+        if at_start and pattern.startswith('**/', index):
+            parts.append('(?:.*/)?')
+            index += 3
+            continue
+        if at_start and pattern[index:] == '**':
+            parts.append('.*')
+            break
+
+        character = pattern[index]
+        index += 1
+        if character == '*':
+            parts.append('[^/]*')
+        elif character == '?':
+            parts.append('[^/]')
+        elif character == '\\' and index < len(pattern):
+            parts.append(re.escape(pattern[index]))
+            index += 1
+        elif character == '[':
+            end = index
+            if end < len(pattern) and pattern[end] in '!^':
+                end += 1
+            if end < len(pattern) and pattern[end] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end < 0:
+                parts.append('\\[')
+                continue
+            members = pattern[index:end].replace('\\', '\\\\')
+            if members[:1] in ('!', '^'):
+                members = '^/' + members[1:]
+            parts.append('[' + members + ']')
+            index = end + 1
+        else:
+            parts.append(re.escape(character))
+    return ''.join(parts)
+
+
+def _is_python_script(filename):
+    """Return True if the first line of file is a Python shebang."""
+    try:
+        with open(filename, 'rb') as input_file:
+            data = input_file.read(MAX_SHEBANG_BYTES)
+    except OSError:
+        return False
+    lines = decode_source(data)[0].splitlines()
+    return bool(lines) and PYTHON_SHEBANG_REGEX.match(lines[0]) is not None
+
+
+def _git(*arguments, **kwargs):
+    """Return output of git run with arguments."""
+    import subprocess
+    output = subprocess.check_output(('git',) + arguments,
+                                     stderr=subprocess.PIPE, **kwargs)
+    return output.decode('utf-8', 'surrogateescape')
 
-    return (any(changed_and_error[0] for changed_and_error in result),
-            any(changed_and_error[1] for changed_and_error in result))
+
+def git_changed_files(revision=None, staged=False, directory=None):
+    """Return absolute paths of files changed in the git repository.
+
+    The repository is the one containing directory, which defaults to the
+    working directory.
+
+    With revision, files are compared against it. With staged, only changes
+    in the index are considered. Without staged, untracked files count as
+    changed too. Deleted files are left out.
+
+    Raise OSError if git cannot be run and subprocess.CalledProcessError if
+    it fails.
+    """
+    top_level = _git('rev-parse', '--show-toplevel',
+                     cwd=directory).rstrip('\n')
+
+    command = ['diff', '--name-only', '-z', '--diff-filter=ACMR']
+    if staged:
+        command.append('--cached')
+    if revision is not None:
+        command.append(revision)
+    command.append('--')
+    names = _git(*command, cwd=top_level).split('\0')
+
+    if not staged:
+        names += _git('ls-files', '--others', '--exclude-standard', '-z',
+                      cwd=top_level).split('\0')
+
+    return [os.path.join(top_level, name) for name in names if name]
+
+
+def git_blob_ids(directory=None):
+    """Return git blob IDs of the files that match the git index.
+
+    The result maps absolute paths to the IDs of the blobs in the index of
+    the repository containing directory, which defaults to the working
+    directory. Files that "git diff-files" reports as modified are left
+    out, as are conflicted files, symbolic links, submodules and files
+    whose line endings differ between index and working tree, since their
+    blob differs from their content. Content changed by clean filters
+    still has the ID of the filtered blob, which the file cannot have, so
+    it is never found in the cache.
+
+    Raise OSError if git cannot be run and subprocess.CalledProcessError if
+    it fails.
+    """
+    top_level = _git('rev-parse', '--show-toplevel',
+                     cwd=directory).rstrip('\n')
+
+    modified = set(_git('diff-files', '--name-only', '-z',
+                        cwd=top_level).split('\0'))
+
+    blob_ids = {}
+    for record in _git('ls-files', '--stage', '--eol', '-z',
+                       cwd=top_level).split('\0'):
+        if not record:
+            continue
+        (entry, line_endings, name) = record.split('\t', 2)
+        (mode, object_id, stage) = entry.split(' ')
+        (index_line_ending, file_line_ending) = line_endings.split()[:2]
+        if (
+            mode in ('100644', '100755') and stage == '0' and
+            name not in modified and
+            index_line_ending[2:] == file_line_ending[2:]
+        ):
+            blob_ids[os.path.join(top_level, name)] = object_id
+    return blob_ids
+
+
+def git_blob_id(data):
+    """Return the ID git gives a blob of data in a SHA-1 repository."""
+    import hashlib
+    digest = hashlib.sha1(b'blob %d\0' % len(data))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def _skip_formatted_blobs(filenames, args, standard_error):
+    """Yield filenames except those whose blob is known to be formatted.
+
+    Files are looked up in args.blob_ids by real path, which is found for
+    their directory only, since the files themselves are not symbolic links.
+    """
+    cache = _result_cache(args.cache_dir)
+    directories = {}
+    for name in filenames:
+        (directory, base_name) = os.path.split(name)
+        if directory not in directories:
+            # The pipeline depends on the directory of the file only.
+            directories[directory] = (
+                os.path.realpath(directory),
+                get_pipeline(**_format_options(args, name)))
+        (real_directory, pipeline) = directories[directory]
+        object_id = args.blob_ids.get(os.path.join(real_directory,
+                                                   base_name))
+
+        if object_id is not None:
+            key = ResultCache.blob_key(object_id, pipeline, args.max_passes)
+            if cache.entry(key) == ResultCache.UNCHANGED:
+                if args.verbose:
+                    print('{}: unchanged'.format(name),
+                          file=standard_error or sys.stderr)
+                continue
+        yield name
+
+
+def git_line_ranges(revision=None, directory=None):
+    """Return the changed lines of files in the git working tree.
+
+    The result maps absolute paths to lists of (first, last) ranges of line
+    numbers in the working tree file. Files are compared against revision,
+    or against the index without it. The lines around deleted lines count
+    as changed. Untracked files map to None since all of their lines are
+    new.
+
+    Raise OSError if git cannot be run and subprocess.CalledProcessError if
+    it fails.
+    """
+    top_level = _git('rev-parse', '--show-toplevel',
+                     cwd=directory).rstrip('\n')
+
+    command = ['diff', '-U0', '--no-color', '--no-ext-diff', '--no-prefix',
+               '--diff-filter=ACMR']
+    if revision is not None:
+        command.append(revision)
+    command.append('--')
+
+    line_ranges = {}
+    path = None
+    for line in _git(*command, cwd=top_level).splitlines():
+        if line.startswith('+++ '):
+            name = line[4:].rstrip('\t')
+            if name.startswith('"'):
+                name = codecs.escape_decode(
+                    name[1:-1].encode('utf-8', 'surrogateescape'))[0].decode(
+                        'utf-8', 'surrogateescape')
+            path = os.path.join(top_level, name)
+            line_ranges[path] = []
+        elif line.startswith('@@ ') and path is not None:
+            match = re.match(r'@@ -\S+ \+(\d+)(?:,(\d+))? @@', line)
+            first = int(match.group(1))
+            count = 1 if match.group(2) is None else int(match.group(2))
+            if count:
+                line_ranges[path].append((first, first + count - 1))
+            else:
+                # Lines were deleted after line first.
+                line_ranges[path].append((max(first, 1), first + 1))
+        elif line.startswith('diff '):
+            path = None
+
+    for name in _git('ls-files', '--others', '--exclude-standard', '-z',
+                     cwd=top_level).split('\0'):
+        if name:
+            line_ranges[os.path.join(top_level, name)] = None
+
+    return line_ranges
+
+
+def select_changed_files(filenames, changed, recursive, exclude):
+    """Yield the files among filenames that are in changed.
+
+    changed holds real paths, as returned by git_changed_files().
+
+    Directories select the changed files below them when recursive, with
+    the same exclusion rules as the recursive traversal of
+    format_multiple_files().
+    """
+    matcher = ExcludeMatcher(exclude)
+    changed = sorted(set(changed))
+    selected = set()
+    for name in filenames:
+        path = os.path.realpath(name)
+        if recursive and os.path.isdir(name):
+            candidates = []
+            for changed_path in changed:
+                if (
+                    not changed_path.startswith(path + os.sep) or
+                    not os.path.isfile(changed_path)
+                ):
+                    continue
+
+                candidate = name
+                for part in os.path.relpath(changed_path, path).split(os.sep):
+                    candidate = os.path.join(candidate, part)
+                    if matcher.excludes_entry(candidate):
+                        break
+                else:
+                    if (
+                        candidate.endswith('.py') or
+                        _is_python_script(candidate)
+                    ):
+                        candidates.append(candidate)
+        elif path in changed:
+            if matcher.excludes(name):
+                continue
+            candidates = [name]
+        else:
+            continue
+
+        for candidate in candidates:
+            if os.path.abspath(candidate) not in selected:
+                selected.add(os.path.abspath(candidate))
+                yield candidate
 
 
 def parse_args(argv):
@@ -243,9 +2844,51 @@ def parse_args(argv):
                         help='sort imports')
     parser.add_argument('--add-trailing-comma', action='store_true',
                         help='add trailing comma to code (requires "aggressive")')
+    parser.add_argument('--changed-since', metavar='rev',
+                        help='only format files that changed in the git '
+                             'repository since this revision')
+    parser.add_argument('--staged', action='store_true',
+                        help='only format files with changes staged in the '
+                             'git index')
+    parser.add_argument('--git-index', action='store_true',
+                        help='skip files that match the git index and whose '
+                             'blob the cache knows to be formatted, without '
+                             'reading them')
+    parser.add_argument('--diff-base', metavar='rev',
+                        help='only format lines that changed in the git '
+                             'working tree since this revision')
+    parser.add_argument('--max-passes', type=int, metavar='n', default=1,
+                        help='run the formatters up to n times, until the '
+                             'code stops changing (default: %(default)s)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and format files whenever they '
+                             'change')
+    parser.add_argument('--watch-interval', type=float, metavar='seconds',
+                        default=0.5,
+                        help='how often to look for changed files in watch '
+                             'mode (default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+                        help="don't write files or print diffs; print the "
+                             'names of files that would be changed and exit '
+                             'with status 3 if there are any')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='stop at the first file that would be changed '
+                             '(requires "check")')
+    parser.add_argument('--profile', action='store_true',
+                        help='print time spent in each formatter')
+    parser.add_argument('--profile-json', metavar='path',
+                        help='write time spent in each formatter to path as '
+                             'JSON')
     parser.add_argument('-j', '--jobs', type=int, metavar='n', default=1,
                         help='number of parallel jobs; '
                              'match CPU count if value is less than 1')
+    parser.add_argument('--split-lines', type=int, metavar='n', default=0,
+                        help='split files with at least n lines at top-level '
+                             'definitions and format the parts in parallel '
+                             '(requires "jobs" greater than 1)')
+    parser.add_argument('--walk-jobs', type=int, metavar='n', default=1,
+                        help='number of threads that list directories when '
+                             'recursive (default: %(default)s)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='print verbose messages')
     parser.add_argument('--exclude', action='append',
@@ -253,21 +2896,53 @@ def parse_args(argv):
                         help='exclude files this pattern; '
                              'specify this multiple times for multiple '
                              'patterns')
+    parser.add_argument('--gitignore', action='store_true',
+                        help='when recursive, also exclude files ignored by '
+                             '.gitignore files and .git/info/exclude')
     parser.add_argument('--no-config', action='store_false', dest='config',
                         help="don't look for and apply local configuration "
                              'files; if not passed, defaults are updated with '
                              "any config files in the project's root "
                              'directory')
+    parser.add_argument('--cache-dir', default=default_cache_directory(),
+                        metavar='dir',
+                        help='directory of the cache of formatting results '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        help="don't read or write the cache of formatting "
+                             'results')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep formatters loaded and serve formatting '
+                             'requests on a Unix socket')
+    parser.add_argument('--use-daemon', action='store_true',
+                        help='format through a running daemon; format '
+                             'in-process if none is running')
+    parser.add_argument('--socket', default=default_socket_path(),
+                        metavar='path',
+                        help='socket of the daemon (default: %(default)s)')
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + __version__)
-    parser.add_argument('files', nargs='+', help='files to format')
+    parser.add_argument('files', nargs='*', help='files to format')
 
     args = parser.parse_args(argv[1:])
 
+    if not args.files and not args.daemon:
+        parser.error('the following arguments are required: files')
+
+    if args.max_passes < 1:
+        parser.error('--max-passes must be at least 1')
+
     if args.jobs < 1:
         import multiprocessing
         args.jobs = multiprocessing.cpu_count()
 
+    # Lines to format by real path of the file, set by _main() from
+    # --diff-base. Files that are missing are formatted entirely.
+    args.line_ranges = None
+
+    # Git blob IDs of files by real path, set by _main() for --git-index.
+    args.blob_ids = None
+
     return args
 
 
@@ -278,9 +2953,15 @@ def _main(argv, standard_out, standard_error):
     """
     args = parse_args(argv)
 
-    if args.jobs > 1 and not args.in_place:
-        print('parallel jobs requires --in-place',
-              file=standard_error)
+    if args.daemon:
+        return serve_daemon(args.socket, args.jobs, standard_error)
+
+    if args.check and args.in_place:
+        print('--check cannot be used with --in-place', file=standard_error)
+        return 2
+
+    if args.fail_fast and not args.check:
+        print('--fail-fast requires --check', file=standard_error)
         return 2
 
     if not args.aggressive:
@@ -299,11 +2980,80 @@ def _main(argv, standard_out, standard_error):
                   file=standard_error)
             return 2
 
-    changed_and_error = format_multiple_files(set(args.files),
+    # Remove duplicates but keep the order so that output is deterministic.
+    filenames = list(dict.fromkeys(args.files))
+
+    if args.watch and (
+        args.changed_since is not None or args.staged or
+        args.diff_base is not None
+    ):
+        print('--watch cannot be used with --changed-since, --staged or '
+              '--diff-base', file=standard_error)
+        return 2
+
+    if args.watch and any(is_stdin(name) for name in args.files):
+        print('--watch cannot be used with standard input',
+              file=standard_error)
+        return 2
+
+    if args.diff_base is not None and args.max_passes > 1:
+        print('--diff-base cannot be used with --max-passes',
+              file=standard_error)
+        return 2
+
+    if args.diff_base is not None and (
+        args.changed_since is not None or args.staged
+    ):
+        print('--diff-base cannot be used with --changed-since or --staged',
+              file=standard_error)
+        return 2
+
+    if args.git_index and (args.diff_base is not None or not args.cache):
+        print('--git-index cannot be used with --diff-base or --no-cache',
+              file=standard_error)
+        return 2
+
+    if (
+        args.changed_since is not None or args.staged or
+        args.diff_base is not None or args.git_index
+    ):
+        import subprocess
+        try:
+            if args.diff_base is not None:
+                args.line_ranges = git_line_ranges(args.diff_base)
+                changed = args.line_ranges
+            elif args.changed_since is not None or args.staged:
+                changed = git_changed_files(args.changed_since, args.staged)
+            else:
+                changed = None
+            if args.git_index:
+                args.blob_ids = git_blob_ids()
+        except OSError as exception:
+            print('cannot run git: {}'.format(exception),
+                  file=standard_error)
+            return 2
+        except subprocess.CalledProcessError as exception:
+            print('git failed: {}'.format(
+                exception.stderr.decode('utf-8', 'replace').strip()),
+                file=standard_error)
+            return 2
+        if changed is not None:
+            filenames = list(select_changed_files(filenames, changed,
+                                                  args.recursive,
+                                                  args.exclude_patterns))
+
+    if args.watch:
+        return watch_files(filenames, args, standard_out, standard_error)
+
+    changed_and_error = format_multiple_files(filenames,
                                               args,
                                               standard_out,
                                               standard_error)
-    return 1 if changed_and_error[1] else 0
+    if changed_and_error[1]:
+        return 1
+    if args.check and changed_and_error[0]:
+        return 3
+    return 0
 
 
 def main():
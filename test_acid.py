@@ -4,15 +4,13 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import functools
 import os
 import sys
-import subprocess
+import time
 
+import pyformat
 
-ROOT_PATH = os.path.abspath(os.path.dirname(__file__))
-PYFORMAT_BIN = os.path.join(ROOT_PATH, 'pyformat.py')
-
-import autopep8
 
 if sys.stdout.isatty():
     YELLOW = '\x1b[33m'
@@ -22,82 +20,118 @@ else:
     END = ''
 
 
+# Number of times formatted code is formatted again to check idempotence.
+MAX_PASSES = 5
+
+# Options of the run, set in each pool worker by initialize_worker().
+_worker_args = None
+
+
 def colored(text, color):
     """Return color coded text."""
     return color + text + END
 
 
-def readlines(filename):
-    """Return contents of file as a list of lines."""
-    with autopep8.open_with_encoding(
-            filename,
-            encoding=autopep8.detect_encoding(filename)) as f:
-        return f.readlines()
-
-
-def diff(before, after):
-    """Return diff of two files."""
+def diff(before, after, filename):
+    """Return diff of two sources."""
     import difflib
     return ''.join(difflib.unified_diff(
-        readlines(before),
-        readlines(after),
-        before,
-        after))
+        before.splitlines(True),
+        after.splitlines(True),
+        filename,
+        filename))
 
 
-def run(filename, verbose=False, options=None):
-    """Run pyformat on file at filename.
+def initialize_worker(args):
+    """Store options in a pool worker so that tasks need not carry them."""
+    global _worker_args
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_args = args
+
 
-    Return True on success.
+def run(filename, args=None):
+    """Run pyformat on file at filename.
 
+    Return (filename, error, seconds, diff). error is None on success.
     """
-    if not options:
-        options = []
-
-    import test_pyformat
-    with test_pyformat.temporary_directory() as temp_directory:
-        temp_filename = os.path.join(temp_directory,
-                                     os.path.basename(filename))
-        import shutil
-        shutil.copyfile(filename, temp_filename)
-
-        if 0 != subprocess.call([PYFORMAT_BIN, '--in-place', temp_filename] +
-                                options):
-            sys.stderr.write('pyformat crashed on ' + filename + '\n')
-            return False
+    args = args or _worker_args
+    start_time = time.perf_counter()
+    try:
+        source = pyformat.read_file(filename)[0]
+    except (OSError, UnicodeDecodeError):
+        return (filename, None, 0.0, '')
 
+    try:
+        formatted_source = pyformat.format_code(source,
+                                                aggressive=args.aggressive)
+    except Exception as exception:
+        return (filename,
+                'pyformat crashed on {}: {}: {}'.format(
+                    filename, type(exception).__name__, exception),
+                time.perf_counter() - start_time, '')
+    seconds = time.perf_counter() - start_time
+
+    file_diff = ''
+    if args.verbose:
+        file_diff = diff(source, formatted_source, filename)
+
+    if check_syntax(source):
         try:
-            file_diff = diff(filename, temp_filename)
-            if verbose:
-                sys.stderr.write(file_diff)
-
-            if check_syntax(filename):
-                try:
-                    check_syntax(temp_filename, raise_error=True)
-                except (SyntaxError, TypeError,
-                        UnicodeDecodeError) as exception:
-                    sys.stderr.write('pyformat broke ' + filename + '\n' +
-                                     str(exception) + '\n')
-                    return False
-        except IOError as exception:
-            sys.stderr.write(str(exception) + '\n')
+            check_syntax(formatted_source, raise_error=True)
+        except (SyntaxError, TypeError, ValueError) as exception:
+            return (filename,
+                    'pyformat broke {}\n{}'.format(filename, exception),
+                    seconds, file_diff)
+
+        if args.check_ast and abstract_syntax(source) != abstract_syntax(
+                formatted_source):
+            return (filename,
+                    'pyformat changed the meaning of {}'.format(filename),
+                    seconds, file_diff)
+
+    if args.check_idempotence:
+        (_, passes, converged) = pyformat.iterate_to_fixpoint(
+            functools.partial(pyformat.format_code,
+                              aggressive=args.aggressive),
+            formatted_source, MAX_PASSES)
+        if passes > 1:
+            return (filename,
+                    'pyformat is not idempotent on {} ({} after {} '
+                    'passes)'.format(filename,
+                                     'converged' if converged
+                                     else 'still changing',
+                                     passes + 1),
+                    seconds, file_diff)
+
+    return (filename, None, seconds, file_diff)
+
+
+def check_syntax(source, raise_error=False):
+    """Return True if syntax is okay."""
+    try:
+        compile(source, '<string>', 'exec', dont_inherit=True)
+        return True
+    except (SyntaxError, TypeError, ValueError):
+        if raise_error:
+            raise
+        else:
+            return False
 
-    return True
 
+def abstract_syntax(source):
+    """Return dump of the syntax tree of source without docstrings.
 
-def check_syntax(filename, raise_error=False):
-    """Return True if syntax is okay."""
-    with autopep8.open_with_encoding(
-            filename,
-            encoding=autopep8.detect_encoding(filename)) as input_file:
-        try:
-            compile(input_file.read(), '<string>', 'exec', dont_inherit=True)
-            return True
-        except (SyntaxError, TypeError, UnicodeDecodeError):
-            if raise_error:
-                raise
-            else:
-                return False
+    docformatter reformats docstrings, so only their presence counts.
+    """
+    import ast
+    tree = ast.parse(source)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef,
+                             ast.AsyncFunctionDef)):
+            if ast.get_docstring(node, clean=False) is not None:
+                node.body[0].value.value = ''
+    return ast.dump(tree)
 
 
 def process_args():
@@ -108,70 +142,117 @@ def process_args():
     parser.add_argument('--aggressive', action='store_true',
                         help='pass to the pyformat "--aggressive" option')
 
+    parser.add_argument('--check-ast', action='store_true',
+                        help='check that formatting keeps the syntax tree, '
+                             'apart from docstrings; aggressive formatting '
+                             'may change it on purpose')
+
+    parser.add_argument('--check-idempotence', action='store_true',
+                        help='check that formatting formatted code changes '
+                             'nothing')
+
+    parser.add_argument('-j', '--jobs', type=int, metavar='n', default=0,
+                        help='number of parallel jobs; '
+                             'match CPU count if value is less than 1')
+
+    parser.add_argument('--summary', metavar='path',
+                        help='write a JSON summary with per-file timings to '
+                             'path')
+
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='print verbose messages')
 
     parser.add_argument('files', nargs='*', help='files to format')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        import multiprocessing
+        args.jobs = multiprocessing.cpu_count()
+
+    return args
+
+
+def find_files(paths):
+    """Yield Python files in paths, recursively, each once."""
+    filenames = list(paths)
+    completed_filenames = set()
+
+    while filenames:
+        name = os.path.realpath(filenames.pop(0))
+        if not os.path.exists(name):
+            # Invalid symlink.
+            continue
+
+        if name in completed_filenames:
+            sys.stderr.write(
+                colored(
+                    '--->  Skipping previously tested ' + name + '\n',
+                    YELLOW))
+            continue
+        else:
+            completed_filenames.add(name)
+
+        if os.path.isdir(name):
+            for root, directories, children in os.walk('{}'.format(name)):
+                filenames += [os.path.join(root, f) for f in children
+                              if f.endswith('.py') and
+                              not f.startswith('.')]
+
+                directories[:] = [d for d in directories
+                                  if not d.startswith('.')]
+        else:
+            yield name
 
 
 def check(args):
     """Run recursively run pyformat on directory of files.
 
-    Return False if the fix results in broken syntax.
-
+    Failures are written as they occur. Return False if pyformat crashed
+    or the fix results in broken syntax.
     """
+    import multiprocessing
+
     if args.files:
         dir_paths = args.files
     else:
         dir_paths = [path for path in sys.path
                      if os.path.isdir(path)]
 
-    options = []
-    if args.aggressive:
-        options.append('--aggressive')
-
-    filenames = dir_paths
-    completed_filenames = set()
+    failures = []
+    timings = {}
+    start_time = time.perf_counter()
 
-    while filenames:
-        try:
-            name = os.path.realpath(filenames.pop(0))
-            if not os.path.exists(name):
-                # Invalid symlink.
-                continue
-
-            if name in completed_filenames:
-                sys.stderr.write(
-                    colored(
-                        '--->  Skipping previously tested ' + name + '\n',
-                        YELLOW))
-                continue
-            else:
-                completed_filenames.update(name)
-
-            if os.path.isdir(name):
-                for root, directories, children in os.walk('{}'.format(name)):
-                    filenames += [os.path.join(root, f) for f in children
-                                  if f.endswith('.py') and
-                                  not f.startswith('.')]
-
-                    directories[:] = [d for d in directories
-                                      if not d.startswith('.')]
-            else:
-                verbose_message = '--->  Testing with ' + name
-                sys.stderr.write(colored(verbose_message + '\n', YELLOW))
-
-                if not run(os.path.join(name), verbose=args.verbose,
-                           options=options):
-                    return False
-        except (UnicodeDecodeError, UnicodeEncodeError) as exception:
-            # Ignore annoying codec problems on Python 2.
-            print(exception, file=sys.stderr)
-            continue
-
-    return True
+    pool = multiprocessing.Pool(args.jobs,
+                                initializer=initialize_worker,
+                                initargs=(args,))
+    try:
+        for (filename, error, seconds, file_diff) in pool.imap_unordered(
+                run, find_files(dir_paths)):
+            timings[filename] = seconds
+            sys.stderr.write(colored('--->  Tested ' + filename + '\n',
+                                     YELLOW))
+            sys.stderr.write(file_diff)
+            if error:
+                failures.append({'filename': filename, 'error': error})
+                sys.stderr.write(error + '\n')
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.summary:
+        import json
+        with open(args.summary, 'w') as output_file:
+            json.dump({'files': len(timings),
+                       'failures': failures,
+                       'seconds': time.perf_counter() - start_time,
+                       'timings': timings},
+                      output_file, indent=2)
+
+    return not failures
 
 
 def main():
@@ -7,11 +7,15 @@ from __future__ import unicode_literals
 
 import contextlib
 import io
+import json
 import os
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
@@ -37,6 +41,23 @@ else:
                             'pyformat.py')]  # pragma: no cover
 
 
+# Budget for the cumulative time of "import pyformat" in microseconds.
+IMPORT_TIME_BUDGET = 150000
+
+FORMATTER_MODULES = ('add_trailing_comma', 'autoflake', 'autopep8',
+                     'docformatter', 'isort', 'lib2to3', 'unify')
+
+
+def setUpModule():
+    # Keep the result cache of tests that do not choose a cache directory out
+    # of the user's cache and away from the results of earlier runs.
+    cache_home = tempfile.mkdtemp()
+    environment = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': cache_home})
+    environment.start()
+    unittest.addModuleCleanup(environment.stop)
+    unittest.addModuleCleanup(shutil.rmtree, cache_home)
+
+
 class TestUnits(unittest.TestCase):
 
     def test_format_code(self):
@@ -81,6 +102,835 @@ class TestUnits(unittest.TestCase):
                 aggressive=True,
                 remove_unused_variables=True))
 
+    def test_decode_source(self):
+        self.assertEqual(('x = 1\n', 'utf-8'),
+                         pyformat.decode_source(b'x = 1\n'))
+        self.assertEqual(('x = "\u00e9"\n', 'utf-8'),
+                         pyformat.decode_source('x = "\u00e9"\n'.encode()))
+        self.assertEqual(('x = 1\n', 'utf-8-sig'),
+                         pyformat.decode_source(b'\xef\xbb\xbfx = 1\n'))
+
+    def test_decode_source_with_coding_cookie(self):
+        self.assertEqual(
+            ('#!/usr/bin/env python\n# coding: latin-1\nx = "\u00e9"\n',
+             'iso-8859-1'),
+            pyformat.decode_source(
+                b'#!/usr/bin/env python\n# coding: latin-1\nx = "\xe9"\n'))
+        self.assertEqual(
+            ('x = 1\n# coding: latin-1\n', 'utf-8'),
+            pyformat.decode_source(b'x = 1\n# coding: latin-1\n'))
+
+    def test_decode_source_falls_back_to_latin_1(self):
+        for data in [b'x = "\xe9"\n',
+                     b'# \xe9\nx = 1\n',
+                     b'# coding: unknown\nx = 1\n',
+                     b'\xef\xbb\xbf# coding: latin-1\nx = 1\n']:
+            self.assertEqual((data.decode('latin-1'), 'latin-1'),
+                             pyformat.decode_source(data))
+
+    def test_detect_io_encoding(self):
+        self.assertEqual(
+            'cp1252',
+            pyformat.detect_io_encoding(
+                io.BytesIO(b'# \xe9\n# vim: fileencoding=cp1252\n')))
+
+    def test_get_pipeline_is_reused(self):
+        self.assertIs(pyformat.get_pipeline(aggressive=True),
+                      pyformat.get_pipeline(aggressive=True))
+        self.assertIsNot(pyformat.get_pipeline(aggressive=True),
+                         pyformat.get_pipeline(aggressive=False))
+
+    def test_get_pipeline_keys_on_configuration(self):
+        with temporary_directory() as directory:
+            for name in ['a', 'b']:
+                os.mkdir(os.path.join(directory, name))
+            pyformat._forget_configuration()
+            self.assertIs(
+                pyformat.get_pipeline(
+                    apply_config=True,
+                    filename=os.path.join(directory, 'a', 'x.py')),
+                pyformat.get_pipeline(
+                    apply_config=True,
+                    filename=os.path.join(directory, 'b', 'x.py')))
+
+            with open(os.path.join(directory, 'b', 'setup.cfg'),
+                      'w') as output_file:
+                output_file.write('[pycodestyle]\nmax-line-length = 120\n')
+            pyformat._forget_configuration()
+            self.assertIsNot(
+                pyformat.get_pipeline(
+                    apply_config=True,
+                    filename=os.path.join(directory, 'a', 'x.py')),
+                pyformat.get_pipeline(
+                    apply_config=True,
+                    filename=os.path.join(directory, 'b', 'x.py')))
+        self.assertIs(
+            pyformat.get_pipeline(filename=os.path.join('a', 'x.py')),
+            pyformat.get_pipeline(filename=os.path.join('b', 'x.py')))
+
+    def test_get_pipeline_keys_on_working_directory(self):
+        source = ('def f():\n'
+                  '    """Return the answer to a question asked long ago."""\n')
+        with temporary_directory() as directory:
+            with open(os.path.join(directory, 'pyproject.toml'),
+                      'w') as output_file:
+                output_file.write('[tool.docformatter]\n'
+                                  'wrap-summaries = 30\n')
+            self.assertEqual(source, pyformat.format_code(source))
+            with working_directory(directory):
+                self.assertNotEqual(source, pyformat.format_code(source))
+
+    def test_format_code_reuses_pipeline(self):
+        pyformat.format_code('x = 1\n', aggressive=2)
+        pipeline = pyformat.get_pipeline(aggressive=2)
+        pyformat.format_code('y = 2\n', aggressive=2)
+        self.assertIs(pipeline, pyformat.get_pipeline(aggressive=2))
+
+    def test_pipeline_fingerprint_depends_on_options(self):
+        fingerprint = pyformat.get_pipeline(aggressive=True).fingerprint
+        pyformat.get_pipeline(aggressive=True)('def f():\n    """Doc"""\n')
+        pyformat._pipelines.clear()
+        self.assertEqual(fingerprint,
+                         pyformat.get_pipeline(aggressive=True).fingerprint)
+        self.assertNotEqual(
+            fingerprint, pyformat.get_pipeline(aggressive=False).fingerprint)
+
+    def test_pipeline_fingerprint_depends_on_configuration(self):
+        with temporary_directory() as directory:
+            with working_directory(directory):
+                fingerprint = pyformat.get_pipeline().fingerprint
+            with open(os.path.join(directory, 'pyproject.toml'),
+                      'w') as output_file:
+                output_file.write('[tool.docformatter]\n'
+                                  'wrap-summaries = 30\n')
+            pyformat._forget_configuration()
+            with working_directory(directory):
+                self.assertNotEqual(fingerprint,
+                                    pyformat.get_pipeline().fingerprint)
+
+    def test_pipeline_fingerprint_does_not_import_formatters(self):
+        cumulative_times = import_times([
+            '-c',
+            'import pyformat; '
+            'pyformat.get_pipeline(aggressive=True, apply_config=True, '
+            'sort_imports=True).fingerprint'])
+
+        for name in FORMATTER_MODULES:
+            self.assertNotIn(name, cumulative_times)
+
+    def test_result_cache(self):
+        with temporary_directory() as directory:
+            cache = pyformat.ResultCache(directory)
+            pipeline = pyformat.get_pipeline()
+
+            key = cache.key(b'x = "a"\n', pipeline)
+            self.assertIsNone(cache.get(key, 'x = "a"\n'))
+            cache.put(key, 'x = "a"\n', "x = 'a'\n")
+            self.assertEqual("x = 'a'\n", cache.get(key, 'x = "a"\n'))
+
+            key = cache.key(b'x = 1\n', pipeline)
+            cache.put(key, 'x = 1\n', 'x = 1\n')
+            self.assertEqual('x = 1\n', cache.get(key, 'x = 1\n'))
+
+    def test_result_cache_prune_evicts_least_recently_used(self):
+        with temporary_directory() as directory:
+            cache = pyformat.ResultCache(directory)
+            pipeline = pyformat.get_pipeline()
+            old_key = cache.key(b'old', pipeline)
+            new_key = cache.key(b'new', pipeline)
+            cache.put(old_key, 'old', '1234567')
+            cache.put(new_key, 'new', '1234567')
+            os.utime(cache._path(old_key), (0, 0))
+
+            # Entries count with the disk space they take.
+            cache.max_size = pyformat._allocated_size(
+                os.stat(cache._path(new_key)))
+            cache.prune()
+
+            self.assertIsNone(cache.get(old_key, 'old'))
+            self.assertEqual('1234567', cache.get(new_key, 'new'))
+
+    def test_result_cache_prune_is_due(self):
+        with temporary_directory() as directory:
+            cache = pyformat.ResultCache(directory)
+            self.assertTrue(cache.prune_is_due())
+            self.assertFalse(cache.prune_is_due())
+            self.assertTrue(cache.prune_is_due(interval=0))
+
+            os.utime(os.path.join(directory, pyformat.PRUNE_STAMP_FILENAME),
+                     (0, 0))
+            self.assertTrue(cache.prune_is_due())
+
+    def test_format_file_uses_cache(self):
+        with temporary_directory() as cache_directory:
+            with temporary_file('x = "abc"\n') as filename:
+                args = pyformat.parse_args(['my_fake_program',
+                                            '--cache-dir', cache_directory,
+                                            filename])
+                output_file = io.StringIO()
+                self.assertTrue(
+                    pyformat.format_file(filename, args, output_file))
+
+                with mock.patch.object(pyformat.Pipeline, '__call__',
+                                       side_effect=AssertionError):
+                    cached_output_file = io.StringIO()
+                    self.assertTrue(
+                        pyformat.format_file(filename, args,
+                                             cached_output_file))
+
+                self.assertEqual(output_file.getvalue(),
+                                 cached_output_file.getvalue())
+
+    def test_format_file_caches_fixpoint(self):
+        with temporary_directory() as cache_directory:
+            with temporary_file(UNSTABLE_DOCSTRING) as filename:
+                args = pyformat.parse_args(['my_fake_program', '--in-place',
+                                            '--max-passes=5',
+                                            '--cache-dir', cache_directory,
+                                            filename])
+                stats = {}
+                self.assertTrue(pyformat.format_file(filename, args,
+                                                     io.StringIO(),
+                                                     stats=stats))
+                self.assertEqual({'passes': 3, 'converged': True}, stats)
+
+                with mock.patch.object(pyformat.Pipeline, '__call__',
+                                       side_effect=AssertionError):
+                    self.assertFalse(pyformat.format_file(filename, args,
+                                                          io.StringIO()))
+
+    def test_format_file_does_not_decode_cached_formatted_source(self):
+        with temporary_directory() as cache_directory:
+            with temporary_file("x = 'abc'\n") as filename:
+                args = pyformat.parse_args(['my_fake_program',
+                                            '--cache-dir', cache_directory,
+                                            filename])
+                self.assertFalse(
+                    pyformat.format_file(filename, args, io.StringIO()))
+
+                with mock.patch.object(pyformat, 'decode_source',
+                                       side_effect=AssertionError):
+                    self.assertFalse(
+                        pyformat.format_file(filename, args, io.StringIO()))
+
+    def test_format_file_in_place_keeps_encoding(self):
+        with temporary_directory() as directory:
+            filename = os.path.join(directory, 'latin.py')
+            with open(filename, 'wb') as output_file:
+                output_file.write('# coding: latin-1\r\nx = "caf\u00e9"\r\n'
+                                  .encode('latin-1'))
+            args = pyformat.parse_args(['my_fake_program', '--in-place',
+                                        '--no-cache', filename])
+            self.assertTrue(pyformat.format_file(filename, args,
+                                                 io.StringIO()))
+            with open(filename, 'rb') as input_file:
+                self.assertEqual(
+                    "# coding: latin-1\r\nx = 'caf\u00e9'\r\n".encode(
+                        'latin-1'),
+                    input_file.read())
+
+    def test_stat_index(self):
+        with temporary_directory() as directory:
+            with temporary_file("x = 'abc'\n") as filename:
+                os.utime(filename, ns=(0, 0))
+                path = os.path.abspath(filename)
+                info = os.stat(filename)
+                name = pyformat.StatIndex.filename(pyformat.get_pipeline())
+                index = pyformat.StatIndex(os.path.join(directory, name))
+                self.assertFalse(index.knows(path, info))
+                index.add(path, info)
+                self.assertTrue(index.knows(path, info))
+
+                self.assertTrue(pyformat.StatIndex(index.path).knows(path,
+                                                                     info))
+                pyformat.compact_stat_indexes(directory)
+                self.assertTrue(os.path.exists(index.journal_path))
+                pyformat.compact_stat_indexes(directory, max_journal_size=0)
+                self.assertFalse(os.path.exists(index.journal_path))
+                self.assertTrue(pyformat.StatIndex(index.path).knows(path,
+                                                                     info))
+
+                with open(filename, 'a') as f:
+                    f.write('y = 1\n')
+                os.utime(filename, ns=(0, 0))
+                self.assertFalse(index.knows(path, os.stat(filename)))
+
+    def test_stat_index_drops_missing_files(self):
+        with temporary_directory() as directory:
+            with temporary_file("x = 'abc'\n") as filename:
+                os.utime(filename, ns=(0, 0))
+                path = os.path.abspath(filename)
+                info = os.stat(filename)
+                index = pyformat.StatIndex(os.path.join(directory, 'index'))
+                index.add(path, info)
+                index.add(path + 'missing', info)
+                index.compact(drop_missing=True)
+
+                index = pyformat.StatIndex(index.path)
+                self.assertTrue(index.knows(path, info))
+                self.assertFalse(index.knows(path + 'missing', info))
+
+    def test_result_cache_prune_evicts_stat_indexes(self):
+        with temporary_directory() as directory:
+            cache = pyformat.ResultCache(directory)
+            key = cache.key(b'x', pipeline=pyformat.get_pipeline())
+            cache.put(key, 'x', 'x')
+            old_path = os.path.join(directory,
+                                    pyformat.STAT_INDEX_PREFIX + 'old.json')
+            for path in (old_path, old_path + '.log'):
+                with open(path, 'w') as output_file:
+                    output_file.write('{}')
+                os.utime(path, (0, 0))
+            durations_path = os.path.join(directory,
+                                          pyformat.DURATIONS_FILENAME)
+            with open(durations_path, 'w') as output_file:
+                output_file.write('{}')
+
+            cache.max_size = 2 * pyformat._allocated_size(
+                os.stat(durations_path))
+            cache.prune()
+
+            self.assertEqual([], [name for name in os.listdir(directory)
+                                  if name.startswith(
+                                      pyformat.STAT_INDEX_PREFIX)])
+            self.assertTrue(os.path.exists(durations_path))
+            self.assertEqual('x', cache.get(key, 'x'))
+
+    def test_stat_index_skips_recently_modified_files(self):
+        with temporary_directory() as directory:
+            with temporary_file("x = 'abc'\n") as filename:
+                path = os.path.abspath(filename)
+                info = os.stat(filename)
+                index = pyformat.StatIndex(os.path.join(directory, 'index'))
+                index.add(path, info)
+                self.assertFalse(index.knows(path, info))
+
+    def test_stat_index_depends_on_options(self):
+        self.assertNotEqual(
+            pyformat.StatIndex.filename(pyformat.get_pipeline()),
+            pyformat.StatIndex.filename(pyformat.get_pipeline(aggressive=1)))
+        self.assertNotEqual(
+            pyformat.StatIndex.filename(pyformat.get_pipeline()),
+            pyformat.StatIndex.filename(pyformat.get_pipeline(),
+                                        max_passes=2))
+
+    def test_stat_index_depends_on_repository(self):
+        with temporary_directory() as cache_directory:
+            with temporary_directory() as directory:
+                for name in ['a', 'b']:
+                    os.makedirs(os.path.join(directory, name, '.git'))
+                args = pyformat.parse_args(['my_fake_program',
+                                            '--cache-dir', cache_directory,
+                                            directory])
+                pipeline = pyformat.get_pipeline()
+                self.assertIs(
+                    pyformat._file_stat_index(
+                        os.path.join(directory, 'a', 'x.py'), pipeline, args),
+                    pyformat._file_stat_index(
+                        os.path.join(directory, 'a', 'c', 'x.py'), pipeline,
+                        args))
+                self.assertIsNot(
+                    pyformat._file_stat_index(
+                        os.path.join(directory, 'a', 'x.py'), pipeline, args),
+                    pyformat._file_stat_index(
+                        os.path.join(directory, 'b', 'x.py'), pipeline, args))
+
+    def test_format_file_does_not_read_indexed_files(self):
+        with temporary_directory() as cache_directory:
+            with temporary_file("x = 'abc'\n") as filename:
+                os.utime(filename, ns=(0, 0))
+                args = pyformat.parse_args(['my_fake_program',
+                                            '--cache-dir', cache_directory,
+                                            filename])
+                self.assertFalse(
+                    pyformat.format_file(filename, args, io.StringIO()))
+
+                with mock.patch.object(pyformat, '_read_data',
+                                       side_effect=AssertionError):
+                    self.assertFalse(
+                        pyformat.format_file(filename, args, io.StringIO()))
+
+                with open(filename, 'w') as f:
+                    f.write('x = "abc"\n')
+                os.utime(filename, ns=(0, 0))
+                self.assertTrue(
+                    pyformat.format_file(filename, args, io.StringIO()))
+
+    def test_directory_summaries(self):
+        with temporary_directory() as cache_directory:
+            with temporary_directory() as directory:
+                for name in ['a.py', 'b.py', os.path.join('sub', 'c.py')]:
+                    path = os.path.join(directory, name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'w') as f:
+                        f.write("x = 'abc'\n")
+                    os.utime(path, ns=(0, 0))
+                args = pyformat.parse_args(['my_fake_program', '--recursive',
+                                            '--cache-dir', cache_directory,
+                                            directory])
+
+                def formatted_files():
+                    names = []
+                    with mock.patch.object(
+                            pyformat, 'format_file',
+                            side_effect=lambda name, *_, **__:
+                            names.append(name) or False):
+                        pyformat.format_multiple_files(
+                            [directory], args, io.StringIO(), io.StringIO())
+                    return sorted(os.path.relpath(name, directory)
+                                  for name in names)
+
+                self.assertEqual(
+                    (False, False),
+                    pyformat.format_multiple_files(
+                        [directory], args, io.StringIO(), io.StringIO()))
+                self.assertEqual([], formatted_files())
+
+                path = os.path.join(directory, 'b.py')
+                with open(path, 'w') as f:
+                    f.write('x = "abc"\n')
+                os.utime(path, ns=(0, 0))
+                self.assertEqual(['a.py', 'b.py'], formatted_files())
+
+    def test_format_file_without_cache(self):
+        with temporary_directory() as cache_directory:
+            with temporary_file('x = "abc"\n') as filename:
+                args = pyformat.parse_args(['my_fake_program', '--no-cache',
+                                            '--cache-dir', cache_directory,
+                                            filename])
+                pyformat.format_file(filename, args, io.StringIO())
+                self.assertEqual([], os.listdir(cache_directory))
+
+    def test_iterate_to_fixpoint(self):
+        self.assertEqual(
+            ('ab', 2, True),
+            pyformat.iterate_to_fixpoint(lambda text: text[:2], 'abcd', 5))
+        self.assertEqual(
+            ('abcd', 1, True),
+            pyformat.iterate_to_fixpoint(lambda text: text, 'abcd', 5))
+        self.assertEqual(
+            ('abcdxx', 2, False),
+            pyformat.iterate_to_fixpoint(lambda text: text + 'x', 'abcd', 2))
+
+    def test_format_code_with_max_passes(self):
+        once = pyformat.format_code(UNSTABLE_DOCSTRING)
+        self.assertNotEqual(once, pyformat.format_code(once))
+
+        formatted_source = pyformat.format_code(UNSTABLE_DOCSTRING,
+                                                max_passes=5)
+        self.assertEqual(formatted_source,
+                         pyformat.format_code(formatted_source))
+
+    def test_format_code_with_max_passes_and_line_ranges(self):
+        with self.assertRaises(ValueError):
+            pyformat.format_code('x = 1\n', line_ranges=[(1, 1)],
+                                 max_passes=2)
+
+    def test_result_cache_key_depends_on_max_passes(self):
+        pipeline = pyformat.get_pipeline()
+        self.assertEqual(
+            pyformat.ResultCache.key(b'x = 1\n', pipeline),
+            pyformat.ResultCache.key(b'x = 1\n', pipeline, max_passes=1))
+        self.assertNotEqual(
+            pyformat.ResultCache.key(b'x = 1\n', pipeline),
+            pyformat.ResultCache.key(b'x = 1\n', pipeline, max_passes=2))
+
+    def test_format_code_with_daemon(self):
+        with temporary_directory() as directory:
+            socket_path = os.path.join(directory, 'socket')
+            server = pyformat.make_daemon_server(socket_path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                self.assertEqual(
+                    "x = 'abc'\n",
+                    pyformat.format_code_with_daemon('import os\nx = "abc"\n',
+                                                     socket_path,
+                                                     aggressive=True))
+            finally:
+                server.shutdown()
+                thread.join()
+                server.server_close()
+
+            self.assertFalse(os.path.exists(socket_path))
+
+    def test_daemon_socket_is_private(self):
+        with temporary_directory() as directory:
+            socket_path = os.path.join(directory, 'socket')
+            umask = os.umask(0o022)
+            try:
+                server = pyformat.make_daemon_server(socket_path)
+                try:
+                    self.assertEqual(
+                        0o600, stat.S_IMODE(os.stat(socket_path).st_mode))
+                finally:
+                    server.server_close()
+                self.assertEqual(0o022, os.umask(umask))
+            finally:
+                os.umask(umask)
+
+    def test_format_code_with_daemon_of_other_user(self):
+        with temporary_directory() as directory:
+            socket_path = os.path.join(directory, 'socket')
+            server = pyformat.make_daemon_server(socket_path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with mock.patch.object(pyformat.os, 'getuid',
+                                       return_value=os.getuid() + 1):
+                    self.assertIsNone(
+                        pyformat.format_code_with_daemon('x = "abc"\n',
+                                                         socket_path))
+            finally:
+                server.shutdown()
+                thread.join()
+                server.server_close()
+
+    def test_serve_daemon_does_not_remove_other_files(self):
+        with temporary_file('x = 1\n') as filename:
+            standard_error = io.StringIO()
+            self.assertEqual(1, pyformat.serve_daemon(filename, 1,
+                                                      standard_error))
+            self.assertIn('not a socket', standard_error.getvalue())
+            with open(filename) as input_file:
+                self.assertEqual('x = 1\n', input_file.read())
+
+    def test_format_code_with_daemon_not_running(self):
+        with temporary_directory() as directory:
+            self.assertIsNone(
+                pyformat.format_code_with_daemon(
+                    'x = "abc"\n', os.path.join(directory, 'socket')))
+
+    def test_handle_daemon_request_with_filename(self):
+        with temporary_file('x = "abc"\n') as filename:
+            self.assertEqual(
+                {'source': 'x = "abc"\n',
+                 'encoding': 'utf-8',
+                 'formatted': "x = 'abc'\n"},
+                pyformat._handle_daemon_request({'filename': filename}))
+
+    def test_handle_daemon_request_with_error(self):
+        self.assertIn(
+            'error',
+            pyformat._handle_daemon_request({'source': 'x = 1\n',
+                                             'options': {'aggressive': 'x'}}))
+
+    def test_chunks(self):
+        small = 10
+        large = pyformat.CHUNK_BYTES
+        self.assertEqual(
+            [[(0, 'a'), (1, 'b'), (2, 'c')],
+             [(3, 'd')]],
+            list(pyformat._chunks([(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')],
+                                  [small, small, large, small])))
+
+        self.assertEqual(
+            [pyformat.MAX_CHUNK_LENGTH, 1],
+            [len(chunk) for chunk in pyformat._chunks(
+                enumerate('x' * (pyformat.MAX_CHUNK_LENGTH + 1)),
+                [small] * (pyformat.MAX_CHUNK_LENGTH + 1))])
+
+    def test_longest_first_by_size(self):
+        self.assertEqual(
+            [1, 2, 0],
+            pyformat._longest_first(['a', 'b', 'c'], [10, 30, 20], {}))
+
+    def test_longest_first_with_durations(self):
+        self.assertEqual(
+            [1, 0, 2],
+            pyformat._longest_first(
+                ['a', 'b', 'c'], [10, 30, 20],
+                {os.path.abspath('a'): 10.0,
+                 os.path.abspath('c'): 5.0}))
+
+    def test_durations_history(self):
+        with temporary_directory() as directory:
+            path = os.path.join(directory, 'history', 'durations.json')
+            self.assertEqual({}, pyformat._load_durations(path))
+
+            pyformat._save_durations(path, {'a': 1.0})
+            pyformat._save_durations(path, {'b': 2.0})
+            self.assertEqual({'a': 1.0, 'b': 2.0},
+                             pyformat._load_durations(path))
+
+    def test_format_multiple_files_in_parallel_records_durations(self):
+        with temporary_directory() as directory:
+            with temporary_file('x = "abc"\n') as filename:
+                error_file = io.StringIO()
+                pyformat.format_multiple_files(
+                    [filename],
+                    pyformat.parse_args(['my_fake_program', '--jobs=2',
+                                         '--verbose',
+                                         '--cache-dir', directory, '']),
+                    standard_out=io.StringIO(),
+                    standard_error=error_file)
+
+                self.assertIn('parallel efficiency', error_file.getvalue())
+                self.assertIn(
+                    os.path.abspath(filename),
+                    pyformat._load_durations(
+                        os.path.join(directory,
+                                     pyformat.DURATIONS_FILENAME)))
+
+    def test_pipeline_names(self):
+        self.assertEqual(
+            ('autoflake', 'add_trailing_comma', 'autopep8', 'docformatter',
+             'unify', 'isort'),
+            pyformat.get_pipeline(aggressive=True, sort_imports=True,
+                                  add_trailing_comma=True).names)
+
+    def test_format_code_with_profile(self):
+        profile = {}
+        pyformat.format_code('x = "abc"\n', profile=profile)
+        pyformat.format_code("x = 'abc'\n", profile=profile)
+
+        self.assertEqual(['autopep8', 'docformatter', 'unify'],
+                         list(profile))
+        self.assertEqual(1, profile['unify']['calls'])
+        self.assertEqual(1, profile['unify']['changed'])
+        self.assertEqual(1, profile['unify']['skipped'])
+        self.assertEqual(2, profile['autopep8']['calls'])
+        self.assertEqual(0, profile['autopep8']['changed'])
+        self.assertGreater(profile['autopep8']['wall_time'], 0)
+
+    def test_merge_profiles(self):
+        total = {'unify': {'calls': 1, 'changed': 1, 'skipped': 0,
+                           'wall_time': 1.0, 'cpu_time': 0.5}}
+        pyformat.merge_profiles(
+            total,
+            {'unify': {'calls': 2, 'changed': 0, 'skipped': 1,
+                       'wall_time': 1.0, 'cpu_time': 1.0},
+             'isort': {'calls': 1, 'changed': 1, 'skipped': 0,
+                       'wall_time': 1.0, 'cpu_time': 1.0}})
+        self.assertEqual(
+            {'unify': {'calls': 3, 'changed': 1, 'skipped': 1,
+                       'wall_time': 2.0, 'cpu_time': 1.5},
+             'isort': {'calls': 1, 'changed': 1, 'skipped': 0,
+                       'wall_time': 1.0, 'cpu_time': 1.0}},
+            total)
+
+    def test_source_features(self):
+        self.assertEqual(set(), pyformat.source_features('x = 1\n'))
+        self.assertEqual(
+            {'import', 'string', 'double_quoted_string'},
+            pyformat.source_features('import os\nx = "abc"\n'))
+        self.assertEqual(
+            {'pass', 'string'},
+            pyformat.source_features('def f():\n    """Doc."""\n    pass\n'))
+        self.assertEqual({'multiline_brackets'},
+                         pyformat.source_features('f(\n    x\n)\n'))
+        self.assertEqual({'trailing_comma'},
+                         pyformat.source_features('f(x,)\n'))
+        self.assertIsNone(pyformat.source_features('f(\n'))
+
+    def test_source_features_with_backslash_in_brackets(self):
+        self.assertEqual({'multiline_brackets'},
+                         pyformat.source_features('f(x, \\\n  y)\n'))
+
+    def test_source_features_with_line_ranges(self):
+        source = 'import os\nx = "abc"\nf(\n    x,\n)\n'
+        self.assertEqual({'string', 'double_quoted_string'},
+                         pyformat.source_features(source, [(2, 2)]))
+        self.assertEqual({'multiline_brackets', 'trailing_comma'},
+                         pyformat.source_features(source, [(4, 5)]))
+
+    def test_format_code_with_line_ranges(self):
+        source = 'x = "abc"\ny=2\nz = "def"\n'
+        self.assertEqual('x = "abc"\ny = 2\nz = \'def\'\n',
+                         pyformat.format_code(source,
+                                              line_ranges=[(2, 3)]))
+        self.assertEqual('x = \'abc\'\ny=2\nz = "def"\n',
+                         pyformat.format_code(source,
+                                              line_ranges=[[1, 1]]))
+        self.assertEqual(source, pyformat.format_code(source,
+                                                      line_ranges=[]))
+
+    def test_format_code_with_line_ranges_and_docstrings(self):
+        source = """\
+def f():
+    '''  Hello.  '''
+
+
+def g():
+    '''  Hello.  '''
+"""
+        self.assertEqual("""\
+def f():
+    '''  Hello.  '''
+
+
+def g():
+    \"\"\"Hello.\"\"\"
+""", pyformat.format_code(source, line_ranges=[(5, 6)]))
+
+    def test_keep_changes_in_ranges(self):
+        self.assertEqual(
+            ('a\nB\nc\nd\n', [(2, 2)]),
+            pyformat._keep_changes_in_ranges('a\nb\nc\nd\n',
+                                             'A\nB\nc\nD\n', [(2, 2)]))
+        self.assertEqual(
+            ('a\nb\nc\nB\nD\n', [(3, 5)]),
+            pyformat._keep_changes_in_ranges('a\nb\nc\nd\n',
+                                             'A\nb\nc\nB\nD\n',
+                                             [(3, 4)]))
+        self.assertEqual(
+            ('a\n\n\nb\n', [(2, 4)]),
+            pyformat._keep_changes_in_ranges('a\nb\n', '\na\n\n\nb\n',
+                                             [(2, 2)]))
+        self.assertEqual(
+            ('a\nb\nc\n', [(1, 1)]),
+            pyformat._keep_changes_in_ranges('a\nb\nc\n', 'b\na\nc\n',
+                                             [(1, 1)]))
+        self.assertEqual(
+            ('b\na\nc\n', [(1, 2)]),
+            pyformat._keep_changes_in_ranges('a\nb\nc\n', 'b\na\nc\n',
+                                             [(1, 2)]))
+
+    def test_format_code_with_line_ranges_does_not_undo_part_of_moves(self):
+        source = 'import sys\nimport abc\nx = 1\nimport os\n'
+        for line_ranges in ([(1, 1)], [(4, 4)]):
+            self.assertEqual(source,
+                             pyformat.format_code(source, sort_imports=True,
+                                                  line_ranges=line_ranges))
+        self.assertEqual('import abc\nimport os\nimport sys\n\nx = 1\n',
+                         pyformat.format_code(source, sort_imports=True,
+                                              line_ranges=[(1, 4)]))
+
+    def test_normalize_line_ranges(self):
+        self.assertEqual([(1, 4), (7, 7)],
+                         pyformat._normalize_line_ranges(
+                             [(3, 4), (7, 7), (0, 2), (9, 8)]))
+
+    def test_result_cache_key_depends_on_line_ranges(self):
+        pipeline = pyformat.get_pipeline()
+        self.assertNotEqual(
+            pyformat.ResultCache.key(b'x = 1\n', pipeline),
+            pyformat.ResultCache.key(b'x = 1\n', pipeline, [(1, 1)]))
+        self.assertEqual(
+            pyformat.ResultCache.key(b'x = 1\n', pipeline, [[1, 1]]),
+            pyformat.ResultCache.key(b'x = 1\n', pipeline, [(1, 1)]))
+
+    def test_pipeline_split(self):
+        pipeline = pyformat.get_pipeline(aggressive=True, sort_imports=True)
+        (head, middle, tail) = pipeline.split()
+        self.assertEqual(('autoflake',), head.names)
+        self.assertEqual(('autopep8',), middle.names)
+        self.assertEqual(('docformatter', 'unify', 'isort'), tail.names)
+
+    def test_split_source(self):
+        source = '''\
+import os
+
+
+def f():
+    pass
+def g():
+    pass
+
+# Comment.
+
+def h():
+    pass
+
+
+@decorator
+class C:
+    pass
+'''
+        self.assertEqual(['import os\n\n\n',
+                          'def f():\n    pass\ndef g():\n    pass\n\n'
+                          '# Comment.\n\ndef h():\n    pass\n\n\n',
+                          '@decorator\nclass C:\n    pass\n'],
+                         pyformat.split_source(source, 10))
+        self.assertEqual([source], pyformat.split_source(source, 1))
+        self.assertEqual(['def f():\n    pass\n\nimport os\n'],
+                         pyformat.split_source(
+                             'def f():\n    pass\n\nimport os\n', 2))
+
+    def test_format_code_in_parallel_matches_format_code(self):
+        for options in [{},
+                        {'aggressive': True, 'sort_imports': True,
+                         'add_trailing_comma': True}]:
+            for filename in splittable_standard_library_sample(10):
+                with open(filename, 'rb') as input_file:
+                    source = input_file.read().decode('utf-8')
+                self.assertEqual(pyformat.format_code(source, **options),
+                                 pyformat.format_code_in_parallel(
+                                     source, 2, **options),
+                                 filename)
+
+    def test_format_code_in_parallel_with_autopep8_turned_off(self):
+        source = ''.join(
+            'def f{}():\n    b=2\n    return b\n\n\n'.format(index)
+            for index in range(8))
+        source = source.replace('def f2', '# autopep8: off\ndef f2')
+        source = source.replace('\n\n\ndef f6',
+                                '\n# autopep8: on\n\n\ndef f6')
+        self.assertIn('    b=2\n', pyformat.format_code(source))
+        self.assertLess(1, len(pyformat.split_source(source, 8)))
+        self.assertEqual(pyformat.format_code(source),
+                         pyformat.format_code_in_parallel(source, 2))
+
+    def test_format_code_in_parallel_with_decorators(self):
+        source = ''.join(
+            '@staticmethod\n\n\ndef f{}():\n    return 1\n\n\n'.format(
+                index)
+            for index in range(8))
+        self.assertNotIn('@staticmethod\n\n', pyformat.format_code(source))
+        self.assertLess(1, len(pyformat.split_source(source, 8)))
+        self.assertEqual(pyformat.format_code(source),
+                         pyformat.format_code_in_parallel(source, 2))
+
+    def test_pruned_pipeline_matches_full_pipeline(self):
+        pipeline = pyformat.get_pipeline(aggressive=True, sort_imports=True,
+                                         add_trailing_comma=True)
+        for filename in standard_library_sample():
+            with open(filename, 'rb') as input_file:
+                source = input_file.read().decode('utf-8')
+            self.assertEqual(pipeline(source, prune=False),
+                             pipeline(source),
+                             filename)
+
+    def test_watch_files(self):
+        with temporary_directory() as directory:
+            watched = os.path.join(directory, 'watched.py')
+            excluded = os.path.join(directory, 'excluded.py')
+            for name in (watched, excluded):
+                with open(name, 'w') as output_file:
+                    output_file.write('x = 1\n')
+
+            args = pyformat.parse_args(['my_fake_program', '--in-place',
+                                        '--recursive', '--no-cache',
+                                        '--exclude=excluded.py',
+                                        '--watch-interval=0.01', directory])
+            error_file = io.StringIO()
+            stop = threading.Event()
+            thread = threading.Thread(
+                target=pyformat.watch_files,
+                args=([directory], args, io.StringIO(), error_file, stop),
+                kwargs={'debounce': 0.05})
+            thread.start()
+            try:
+                time.sleep(0.1)
+                for name in (watched, excluded):
+                    with open(name, 'w') as output_file:
+                        output_file.write('x = "abc"\n')
+
+                deadline = time.time() + 30
+                while 'watched.py' not in error_file.getvalue():
+                    self.assertLess(time.time(), deadline)
+                    time.sleep(0.01)
+            finally:
+                stop.set()
+                thread.join()
+
+            with open(watched) as input_file:
+                self.assertEqual("x = 'abc'\n", input_file.read())
+            with open(excluded) as input_file:
+                self.assertEqual('x = "abc"\n', input_file.read())
+            self.assertRegex(error_file.getvalue(),
+                             r'watched\.py: changed in [0-9.]+ ms\n')
+
     def test_format_multiple_files(self):
         with temporary_file('''\
 if True:
@@ -226,6 +1076,22 @@ x = "abc"
 -import os
 -x = "abc"
 +x = 'abc'
+''', '\n'.join(output_file.getvalue().split('\n')[2:]))
+
+    def test_diff_with_use_daemon_falls_back_without_daemon(self):
+        with temporary_directory() as directory:
+            with temporary_file('x = "abc"\n') as filename:
+                output_file = io.StringIO()
+                pyformat._main(argv=['my_fake_program', '--use-daemon',
+                                     '--socket',
+                                     os.path.join(directory, 'socket'),
+                                     filename],
+                               standard_out=output_file,
+                               standard_error=None)
+                self.assertEqual('''\
+@@ -1 +1 @@
+-x = "abc"
++x = 'abc'
 ''', '\n'.join(output_file.getvalue().split('\n')[2:]))
 
     def test_diff_with_empty_file(self):
@@ -263,6 +1129,400 @@ x = 1
                        standard_error=output_file)
         self.assertIn('no such file', output_file.getvalue().lower())
 
+    def test_check(self):
+        with temporary_file('x = "abc"\n') as filename:
+            output_file = io.StringIO()
+            self.assertEqual(
+                3,
+                pyformat._main(argv=['my_fake_program', '--check', filename],
+                               standard_out=output_file,
+                               standard_error=None))
+            self.assertEqual(filename + '\n', output_file.getvalue())
+
+            with open(filename) as f:
+                self.assertEqual('x = "abc"\n', f.read())
+
+    def test_check_without_changes(self):
+        with temporary_file("x = 'abc'\n") as filename:
+            output_file = io.StringIO()
+            self.assertEqual(
+                0,
+                pyformat._main(argv=['my_fake_program', '--check', filename],
+                               standard_out=output_file,
+                               standard_error=None))
+            self.assertEqual('', output_file.getvalue())
+
+    def test_check_cannot_be_used_with_in_place(self):
+        output_file = io.StringIO()
+        self.assertEqual(
+            2,
+            pyformat._main(argv=['my_fake_program', '--check', '--in-place',
+                                 __file__],
+                           standard_out=output_file,
+                           standard_error=output_file))
+        self.assertIn('--in-place', output_file.getvalue())
+
+    def test_fail_fast_requires_check(self):
+        output_file = io.StringIO()
+        self.assertEqual(
+            2,
+            pyformat._main(argv=['my_fake_program', '--fail-fast', __file__],
+                           standard_out=output_file,
+                           standard_error=output_file))
+        self.assertIn('requires --check', output_file.getvalue())
+
+    def test_fail_fast(self):
+        with temporary_file('x = "abc"\n') as first:
+            with temporary_file('y = "abc"\n') as second:
+                output_file = io.StringIO()
+                self.assertEqual(
+                    3,
+                    pyformat._main(argv=['my_fake_program', '--check',
+                                         '--fail-fast', first, second],
+                                   standard_out=output_file,
+                                   standard_error=None))
+                self.assertEqual(first + '\n', output_file.getvalue())
+
+    def test_fail_fast_with_multiple_jobs(self):
+        with temporary_file('x = "abc"\n') as first:
+            with temporary_file('y = "abc"\n') as second:
+                output_file = io.StringIO()
+                self.assertEqual(
+                    3,
+                    pyformat._main(argv=['my_fake_program', '--check',
+                                         '--fail-fast', '--jobs=2',
+                                         first, second],
+                                   standard_out=output_file,
+                                   standard_error=None))
+
+    def test_profile(self):
+        with temporary_file('x = "abc"\n') as filename:
+            error_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--profile', '--no-cache',
+                                 filename],
+                           standard_out=io.StringIO(),
+                           standard_error=error_file)
+            self.assertIn('autopep8', error_file.getvalue())
+            self.assertIn('wall', error_file.getvalue())
+
+    def test_profile_json_with_multiple_jobs(self):
+        with temporary_directory() as directory:
+            profile_filename = os.path.join(directory, 'profile.json')
+            with temporary_file('x = "abc"\n') as first:
+                with temporary_file('y = "abc"\n') as second:
+                    pyformat._main(argv=['my_fake_program', '--no-cache',
+                                         '--jobs=2',
+                                         '--profile-json', profile_filename,
+                                         first, second],
+                                   standard_out=io.StringIO(),
+                                   standard_error=None)
+
+            with open(profile_filename) as input_file:
+                profile = json.load(input_file)
+            self.assertEqual(2, profile['unify']['calls'])
+            self.assertEqual(2, profile['unify']['changed'])
+
+    def test_git_changed_files(self):
+        with temporary_git_repository() as directory:
+            with open(os.path.join(directory, 'committed.py'), 'w') as f:
+                f.write('x = "abc"\n')
+            with open(os.path.join(directory, 'staged.py'), 'w') as f:
+                f.write('x = "abc"\n')
+            with open(os.path.join(directory, 'untracked.py'), 'w') as f:
+                f.write('x = "abc"\n')
+            git(directory, 'add', 'staged.py')
+
+            self.assertEqual(
+                ['committed.py', 'staged.py', 'untracked.py'],
+                sorted(os.path.relpath(path, directory) for path in
+                       pyformat.git_changed_files('HEAD',
+                                                  directory=directory)))
+            self.assertEqual(
+                ['staged.py'],
+                [os.path.relpath(path, directory) for path in
+                 pyformat.git_changed_files(staged=True,
+                                            directory=directory)])
+
+    def test_git_blob_ids(self):
+        with temporary_git_repository() as directory:
+            with open(os.path.join(directory, 'modified.py'), 'w') as f:
+                f.write('x = 1\n')
+            # Stored with LF line endings in the index.
+            with open(os.path.join(directory, 'crlf.py'), 'wb') as f:
+                f.write(b'x = 1\r\n')
+            with open(os.path.join(directory, '.git', 'info', 'attributes'),
+                      'w') as f:
+                f.write('crlf.py text eol=crlf\n')
+            git(directory, 'add', 'modified.py', 'crlf.py')
+            with open(os.path.join(directory, 'modified.py'), 'w') as f:
+                f.write('x = 2\n')
+            with open(os.path.join(directory, 'untracked.py'), 'w') as f:
+                f.write('x = 1\n')
+
+            blob_ids = pyformat.git_blob_ids(directory=directory)
+            self.assertEqual([os.path.join(directory, 'committed.py')],
+                             list(blob_ids))
+            with open(os.path.join(directory, 'committed.py'), 'rb') as f:
+                self.assertEqual(pyformat.git_blob_id(f.read()),
+                                 blob_ids[os.path.join(directory,
+                                                       'committed.py')])
+
+    def test_git_index(self):
+        with temporary_directory() as cache_directory:
+            with temporary_git_repository() as directory:
+                argv = ['my_fake_program', '--check', '--git-index',
+                        '--cache-dir', cache_directory, 'committed.py']
+                with working_directory(directory):
+                    self.assertEqual(0, pyformat._main(argv, io.StringIO(),
+                                                       None))
+                    with mock.patch.object(pyformat, '_read_data',
+                                           side_effect=AssertionError):
+                        self.assertEqual(0, pyformat._main(argv,
+                                                           io.StringIO(),
+                                                           None))
+
+                    with open('committed.py', 'w') as f:
+                        f.write('x = "abc"\n')
+                    output_file = io.StringIO()
+                    self.assertEqual(3, pyformat._main(argv, output_file,
+                                                       None))
+                    self.assertEqual('committed.py\n',
+                                     output_file.getvalue())
+
+    def test_git_index_cannot_be_used_with_no_cache(self):
+        output_file = io.StringIO()
+        self.assertEqual(
+            2,
+            pyformat._main(argv=['my_fake_program', '--git-index',
+                                 '--no-cache', 'a.py'],
+                           standard_out=output_file,
+                           standard_error=output_file))
+        self.assertIn('--git-index', output_file.getvalue())
+
+    def test_select_changed_files(self):
+        with temporary_directory() as directory:
+            directory = os.path.realpath(directory)
+            for name in ['a.py', 'b.py', 'c.txt', 'skip.py']:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write('x = 1\n')
+            changed = [os.path.join(directory, name)
+                       for name in ['a.py', 'c.txt', 'skip.py', 'gone.py']]
+
+            self.assertEqual(
+                [os.path.join(directory, 'a.py')],
+                list(pyformat.select_changed_files(
+                    [directory], changed, True, ['skip*'])))
+            self.assertEqual(
+                [],
+                list(pyformat.select_changed_files(
+                    [directory], changed, False, [])))
+            self.assertEqual(
+                [os.path.join(directory, 'c.txt')],
+                list(pyformat.select_changed_files(
+                    [os.path.join(directory, 'b.py'),
+                     os.path.join(directory, 'c.txt')], changed, False, [])))
+
+    def test_find_files(self):
+        with temporary_directory() as directory:
+            for name in ['b.py', 'a.py', 'notes.txt', 'script', '.hidden.py',
+                         os.path.join('sub', 'c.py'),
+                         os.path.join('.git', 'd.py'),
+                         os.path.join('build', 'e.py')]:
+                path = os.path.join(directory, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write('#!/usr/bin/env python\n' if name == 'script'
+                            else 'x = 1\n')
+            expected = [os.path.join(directory, name)
+                        for name in ['a.py', 'b.py', 'script',
+                                     os.path.join('sub', 'c.py')]]
+
+            self.assertEqual(
+                expected,
+                list(pyformat.find_files([directory], True, ['build'])))
+            self.assertEqual(
+                expected,
+                list(pyformat.find_files([directory], True, ['build'],
+                                         jobs=4)))
+            self.assertEqual(
+                [directory],
+                list(pyformat.find_files([directory], False, ['build'])))
+            self.assertEqual(
+                ['a.py'],
+                list(pyformat.find_files(['a.py', 'skip.py'], True,
+                                         ['skip*'])))
+
+    def test_find_files_does_not_list_excluded_directories(self):
+        with temporary_directory() as directory:
+            os.makedirs(os.path.join(directory, 'node_modules', 'package'))
+            with mock.patch.object(os, 'scandir',
+                                   side_effect=os.scandir) as scandir:
+                self.assertEqual(
+                    [],
+                    list(pyformat.find_files([directory], True,
+                                             ['node_modules'])))
+            self.assertEqual([mock.call(directory)], scandir.call_args_list)
+
+    def test_find_files_with_gitignore(self):
+        with temporary_directory() as directory:
+            files = {
+                '.gitignore': 'node_modules/\n/build\n*_pb2.py\n',
+                os.path.join('.git', 'info', 'exclude'): 'local.py\n',
+                'a.py': '',
+                'local.py': '',
+                'api_pb2.py': '',
+                os.path.join('build', 'b.py'): '',
+                os.path.join('node_modules', 'c.py'): '',
+                os.path.join('src', '.gitignore'): '!keep_pb2.py\ngen/\n',
+                os.path.join('src', 'keep_pb2.py'): '',
+                os.path.join('src', 'build', 'd.py'): '',
+                os.path.join('src', 'gen', 'e.py'): '',
+                os.path.join('src', 'gen.py'): '',
+            }
+            for (name, contents) in files.items():
+                path = os.path.join(directory, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(contents)
+
+            with mock.patch.object(os, 'scandir',
+                                   side_effect=os.scandir) as scandir:
+                self.assertEqual(
+                    [os.path.join(directory, name)
+                     for name in ['a.py',
+                                  os.path.join('src', 'gen.py'),
+                                  os.path.join('src', 'keep_pb2.py'),
+                                  os.path.join('src', 'build', 'd.py')]],
+                    list(pyformat.find_files([directory], True, [],
+                                             gitignore=True)))
+            listed = [call[0][0] for call in scandir.call_args_list]
+            self.assertNotIn(os.path.join(directory, 'node_modules'), listed)
+            self.assertNotIn(os.path.join(directory, 'src', 'gen'), listed)
+
+            self.assertEqual(
+                [os.path.join(directory, 'src', 'keep_pb2.py')],
+                list(pyformat.find_files([os.path.join(directory, 'src')],
+                                         True, ['*gen*', 'build'],
+                                         gitignore=True)))
+
+    def test_gitignore_patterns(self):
+        def ignores(lines, path, is_directory=False):
+            rules = pyformat.GitIgnore(os.sep, lines)
+            return rules.ignores(os.sep + path.replace('/', os.sep),
+                                 is_directory)
+
+        self.assertTrue(ignores(['*.pyc'], 'a/b/c.pyc'))
+        self.assertTrue(ignores(['/a.py'], 'a.py'))
+        self.assertFalse(ignores(['/a.py'], 'b/a.py'))
+        self.assertTrue(ignores(['a/**/b.py'], 'a/x/y/b.py'))
+        self.assertTrue(ignores(['a/**/b.py'], 'a/b.py'))
+        self.assertTrue(ignores(['**/gen/x.py'], 'p/gen/x.py'))
+        self.assertTrue(ignores(['out/'], 'p/out', True))
+        self.assertFalse(ignores(['out/'], 'p/out'))
+        self.assertFalse(ignores(['*.py', '!keep.py'], 'keep.py'))
+        self.assertTrue(ignores(['!keep.py', '*.py'], 'keep.py'))
+        self.assertTrue(ignores(['\\#literal.py'], '#literal.py'))
+        self.assertFalse(ignores(['# comment.py', ''], '# comment.py'))
+        self.assertTrue(ignores(['[!a]b.py'], 'cb.py'))
+        self.assertFalse(ignores(['[!a]b.py'], 'ab.py'))
+        self.assertFalse(ignores(['a?c'], 'a/c'))
+
+    def test_exclude_matcher(self):
+        matcher = pyformat.ExcludeMatcher(['*.pyi', 'build'])
+        self.assertTrue(matcher.excludes('a.pyi'))
+        self.assertTrue(matcher.excludes('build'))
+        self.assertFalse(matcher.excludes('build.py'))
+        self.assertFalse(pyformat.ExcludeMatcher([]).excludes('a.py'))
+        self.assertTrue(matcher.excludes_entry(os.path.join('src', '.git')))
+        self.assertFalse(matcher.excludes_entry(os.path.join('src', 'a.py')))
+
+    def test_changed_since(self):
+        with temporary_git_repository() as directory:
+            with open(os.path.join(directory, 'changed.py'), 'w') as f:
+                f.write('x = "abc"\n')
+            with open(os.path.join(directory, 'unchanged.py'), 'w') as f:
+                f.write('x = "abc"\n')
+            git(directory, 'add', 'unchanged.py')
+            git(directory, 'commit', '-q', '-m', 'Add unchanged.py')
+
+            output_file = io.StringIO()
+            with working_directory(directory):
+                pyformat._main(argv=['my_fake_program', '--check',
+                                     '--changed-since', 'HEAD',
+                                     'changed.py', 'unchanged.py'],
+                               standard_out=output_file,
+                               standard_error=None)
+            self.assertEqual('changed.py\n', output_file.getvalue())
+
+    def test_changed_since_with_bad_revision(self):
+        with temporary_git_repository() as directory:
+            output_file = io.StringIO()
+            with working_directory(directory):
+                self.assertEqual(
+                    2,
+                    pyformat._main(argv=['my_fake_program', '--changed-since',
+                                         'nonexistent_revision', '.'],
+                                   standard_out=output_file,
+                                   standard_error=output_file))
+            self.assertIn('git failed', output_file.getvalue())
+
+    def test_git_line_ranges(self):
+        with temporary_git_repository() as directory:
+            with open(os.path.join(directory, 'committed.py'), 'w') as f:
+                f.write("x = 'abc'\ny = 1\nz = 2\n")
+            git(directory, 'commit', '-q', '-a', '-m', 'Add lines')
+            with open(os.path.join(directory, 'committed.py'), 'w') as f:
+                f.write("x = 'abc'\nz = 2\nw = 3\n")
+            with open(os.path.join(directory, 'untracked.py'), 'w') as f:
+                f.write('x = 1\n')
+
+            self.assertEqual(
+                {os.path.join(directory, 'committed.py'): [(1, 2), (3, 3)],
+                 os.path.join(directory, 'untracked.py'): None},
+                pyformat.git_line_ranges('HEAD', directory=directory))
+            self.assertEqual(
+                {os.path.join(directory, 'committed.py'): [(2, 3)],
+                 os.path.join(directory, 'untracked.py'): None},
+                pyformat.git_line_ranges('HEAD~1', directory=directory))
+
+    def test_diff_base(self):
+        with temporary_git_repository() as directory:
+            with open(os.path.join(directory, 'committed.py'), 'w') as f:
+                f.write('x = "abc"\ny = "def"\n')
+            git(directory, 'commit', '-q', '-a', '-m', 'Add lines')
+            with open(os.path.join(directory, 'committed.py'), 'w') as f:
+                f.write('x = "abc"\ny = "ghi"\n')
+
+            output_file = io.StringIO()
+            with working_directory(directory):
+                pyformat._main(argv=['my_fake_program', '--in-place',
+                                     '--diff-base', 'HEAD', '.',
+                                     '--recursive'],
+                               standard_out=output_file,
+                               standard_error=None)
+            with open(os.path.join(directory, 'committed.py')) as f:
+                self.assertEqual('x = "abc"\ny = \'ghi\'\n', f.read())
+
+    def test_watch_cannot_be_used_with_diff_base(self):
+        output_file = io.StringIO()
+        self.assertEqual(
+            2,
+            pyformat._main(argv=['my_fake_program', '--watch',
+                                 '--diff-base', 'HEAD', '.'],
+                           standard_out=output_file,
+                           standard_error=output_file))
+        self.assertIn('--watch', output_file.getvalue())
+
+    def test_diff_base_cannot_be_used_with_changed_since(self):
+        output_file = io.StringIO()
+        self.assertEqual(
+            2,
+            pyformat._main(argv=['my_fake_program', '--diff-base', 'HEAD',
+                                 '--changed-since', 'HEAD', '.'],
+                           standard_out=output_file,
+                           standard_error=output_file))
+        self.assertIn('--diff-base', output_file.getvalue())
+
     def test_verbose(self):
         output_file = io.StringIO()
         pyformat._main(argv=['my_fake_program', '--verbose', __file__],
@@ -270,6 +1530,15 @@ x = 1
                        standard_error=output_file)
         self.assertIn('.py', output_file.getvalue())
 
+    def test_max_passes_with_verbose(self):
+        with temporary_file(UNSTABLE_DOCSTRING) as filename:
+            output_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--in-place', '--verbose',
+                                 '--no-cache', '--max-passes=5', filename],
+                           standard_out=output_file,
+                           standard_error=output_file)
+            self.assertIn('changed (3 passes)', output_file.getvalue())
+
     def test_in_place(self):
         with temporary_file('''\
 if True:
@@ -301,16 +1570,55 @@ if True:
     x = 'abc'
 ''', f.read())
 
-    def test_multiple_jobs_should_require_in_place(self):
+    def test_multiple_jobs_with_diff(self):
+        with temporary_directory() as directory:
+            filenames = []
+            for index in range(10):
+                filename = os.path.join(directory,
+                                        'file{}.py'.format(index))
+                with open(filename, 'w') as output_file:
+                    output_file.write('x = "{}"\n'.format(index))
+                filenames.append(filename)
+
+            output_file = io.StringIO()
+            self.assertEqual(
+                0,
+                pyformat._main(argv=['my_fake_program', '--jobs=3',
+                                     '--no-cache'] + filenames,
+                               standard_out=output_file,
+                               standard_error=None))
+
+            expected = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--no-cache'] + filenames,
+                           standard_out=expected,
+                           standard_error=None)
+
+            self.assertEqual(expected.getvalue(), output_file.getvalue())
+            self.assertEqual(10, output_file.getvalue().count("+x = '"))
+
+    def test_multiple_jobs_with_nonexistent_file(self):
         output_file = io.StringIO()
         self.assertEqual(
-            2,
-            pyformat._main(argv=['my_fake_program',
-                                 '--jobs=2', __file__],
+            1,
+            pyformat._main(argv=['my_fake_program', '--jobs=2',
+                                 'nonexistent_file'],
                            standard_out=output_file,
                            standard_error=output_file))
+        self.assertIn('no such file', output_file.getvalue().lower())
 
-        self.assertIn('requires --in-place', output_file.getvalue())
+    def test_split_lines(self):
+        line = 'def f{}(x):\n    return "abc"\n\n\n'
+        source = ''.join(line.format(index) for index in range(20))
+        with temporary_file(source) as filename:
+            output_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--in-place',
+                                 '--no-cache', '--jobs=2',
+                                 '--split-lines=10', filename],
+                           standard_out=output_file,
+                           standard_error=None)
+            with open(filename) as f:
+                self.assertEqual(source.replace('"abc"', "'abc'")[:-2],
+                                 f.read())
 
     def test_jobs_less_than_one_should_default_to_cpu_count(self):
         args = pyformat.parse_args(['my_fake_program',
@@ -529,6 +1837,31 @@ x = "abc"
 +x = 'abc'
 """, '\n'.join(output.decode().split('\n')[3:]))
 
+    def test_import_time(self):
+        cumulative_times = import_times(['-c', 'import pyformat'])
+
+        self.assertLess(cumulative_times['pyformat'], IMPORT_TIME_BUDGET)
+        for name in FORMATTER_MODULES:
+            self.assertNotIn(name, cumulative_times)
+
+    def test_empty_file_does_not_import_formatters(self):
+        with temporary_directory() as directory:
+            filename = os.path.join(directory, 'empty.py')
+            open(filename, 'w').close()
+            cumulative_times = import_times(
+                [os.path.join(ROOT_DIRECTORY, 'pyformat.py'),
+                 '--cache-dir', os.path.join(directory, 'cache'), filename])
+
+        for name in FORMATTER_MODULES:
+            self.assertNotIn(name, cumulative_times)
+
+    def test_version_does_not_import_formatters(self):
+        cumulative_times = import_times(
+            [os.path.join(ROOT_DIRECTORY, 'pyformat.py'), '--version'])
+
+        for name in FORMATTER_MODULES:
+            self.assertNotIn(name, cumulative_times)
+
     def test_no_config(self):
         source = """\
 x =1
@@ -570,6 +1903,114 @@ ignore=E
                                  output_file.getvalue().split('\n')[2:]))
 
 
+# docformatter rewraps this docstring differently on each of two passes.
+UNSTABLE_DOCSTRING = '''\
+"""Program/module to trace Python program or function execution.
+
+Sample use, command line:
+  trace.py -c -f counts --ignore-dir '$prefix' spam.py eggs
+  trace.py -t --ignore-dir '$prefix' spam.py eggs
+  trace.py --trackcalls spam.py eggs
+"""
+'''
+
+
+def standard_library_sample(count=20):
+    """Return the smallest UTF-8 Python modules of the standard library.
+
+    Small modules are the most likely to lack the features formatters act
+    on, which makes them good candidates for checking stage pruning.
+    """
+    directory = os.path.dirname(os.__file__)
+    candidates = []
+    for name in os.listdir(directory):
+        filename = os.path.join(directory, name)
+        if not name.endswith('.py') or not os.path.isfile(filename):
+            continue
+        try:
+            with open(filename, 'rb') as input_file:
+                input_file.read().decode('utf-8')
+        except (OSError, UnicodeDecodeError):
+            continue
+        candidates.append((os.path.getsize(filename), filename))
+    return [filename for (_, filename) in sorted(candidates)[:count]]
+
+
+def splittable_standard_library_sample(count=10):
+    """Return the smallest standard library modules with many definitions.
+
+    split_source() splits each of them into several parts.
+    """
+    sample = []
+    for filename in standard_library_sample(count=None):
+        with open(filename, 'rb') as input_file:
+            source = input_file.read().decode('utf-8')
+        if len(pyformat.split_source(source, 8)) >= 4:
+            sample.append(filename)
+            if len(sample) == count:
+                break
+    return sample
+
+
+def git(directory, *arguments):
+    """Run git in directory."""
+    subprocess.check_call(('git',) + arguments, cwd=directory,
+                          stdout=subprocess.DEVNULL)
+
+
+@contextlib.contextmanager
+def temporary_git_repository():
+    """Create a git repository with a single commit and yield its path."""
+    with temporary_directory(tempfile.gettempdir()) as directory:
+        directory = os.path.realpath(directory)
+        git(directory, 'init', '-q')
+        git(directory, 'config', 'user.name', 'Test')
+        git(directory, 'config', 'user.email', 'test@example.com')
+        with open(os.path.join(directory, 'committed.py'), 'w') as f:
+            f.write("x = 'abc'\n")
+        git(directory, 'add', 'committed.py')
+        git(directory, 'commit', '-q', '-m', 'Initial commit')
+        yield directory
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    """Change the working directory for the duration of the context."""
+    original_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(original_directory)
+
+
+def import_times(arguments):
+    """Return cumulative import times of top-level modules in microseconds.
+
+    The times are parsed from the output of "python -X importtime".
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + arguments,
+                             cwd=ROOT_DIRECTORY,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+
+    cumulative_times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # Header.
+            continue
+        name = fields[2].strip().split('.')[0]
+        cumulative_times[name] = max(cumulative,
+                                     cumulative_times.get(name, 0))
+    return cumulative_times
+
+
 @contextlib.contextmanager
 def temporary_file(contents, directory='.', prefix=''):
     """Write contents to temporary file and yield it."""